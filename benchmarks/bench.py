@@ -0,0 +1,168 @@
+# benchmarks for the interpreter's hot paths: synthetic programs of growing
+# size run against a zero-latency MockBackend, so only interpreter time is
+# measured.
+#
+#   python benchmarks/bench.py            # run and compare with baseline.json
+#   python benchmarks/bench.py --save     # run and store a new baseline
+#   python benchmarks/bench.py --only holes --sizes 100 1000
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import silas
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+# PROGRAMS ########################################
+# each takes a size n and returns the program's lines
+
+def recursion(n):
+    # call depth n: Down pops one flag per call until it finds True
+    return (
+        ["> True"] + ["> False"] * n + ["call Down *", "return", ""] +
+        ["# Down", "if-goto base", "call Down *", "## base", "return"]
+    )
+
+def for_loop(n):
+    # n iterations, each appending to an outer block
+    return (
+        ["<items>"] + [f"> item {i}" for i in range(n)] + ["</items>"] +
+        ["<out>", "for x in items", "    <out>", "        > got {x}", "    </out>", "endfor", "</out>", "return"]
+    )
+
+def push_pop(n):
+    # pushes and pops of single lines, to a growing block and to a variable
+    lines = []
+    for i in range(n):
+        lines += [f"> a {i}", "> b", "pop 2 to stash", "> c", "pop t", "> {t}", "pop"]
+    return lines + ["> done", "return"]
+
+def variables(n):
+    # n lines substituting 4 of 16 variables each
+    lines = []
+    for i in range(16):
+        lines += [f"> value {i}", f"pop v{i}"]
+    for i in range(n):
+        lines.append(f"> {{v{i % 16}}} and {{v{(i + 5) % 16}}}, {{v{(i + 9) % 16}}} or {{v{(i + 13) % 16}}}")
+    return lines + ["return"]
+
+def holes(n):
+    # n holes in one growing block
+    return [f"> Q{i}: [a|*\\n]" for i in range(n)] + ["return"]
+
+def loop_holes(n):
+    # a hole per iteration in a fresh iteration block
+    return (
+        ["<items>"] + [f"> item {i}" for i in range(n)] + ["</items>"] +
+        ["<out>", "for x in items", "        > Rate {x}: [rating|*\\n]", "    <out>", "        > {rating}", "    </out>", "endfor", "</out>", "return"]
+    )
+
+benchmarks = {
+    "recursion": (recursion, [100, 1000, 10000]),
+    "for_loop": (for_loop, [100, 1000, 10000]),
+    "push_pop": (push_pop, [100, 1000, 10000]),
+    "variables": (variables, [100, 1000, 10000]),
+    "holes": (holes, [100, 1000, 3000]),
+    "loop_holes": (loop_holes, [100, 1000, 10000]),
+}
+
+# MEASURE ########################################
+
+def measure(lines, repeat=5, min_time=0.2):
+    program = silas.Program.parse(lines)
+    backend = silas.MockBackend(default="7")
+    new = lambda **options: silas.Interpreter(program, backend=backend, **options)
+
+    # instruction count, from one profiled run
+    profiler = silas.Profiler()
+    new(profiler=profiler).run()
+    instructions = sum(line["count"] for line in profiler.report(program)["lines"])
+
+    # best of at least `repeat` runs, and of as many as fit in min_time
+    best = float("inf")
+    runs, spent = 0, 0.0
+    while runs < repeat or spent < min_time:
+        interpreter = new()
+        start = time.perf_counter()
+        interpreter.run()
+        elapsed = time.perf_counter() - start
+        best = min(best, elapsed)
+        runs += 1
+        spent += elapsed
+    n_holes = interpreter.n_completions
+
+    tracemalloc.start()
+    new().run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "instructions": instructions,
+        "holes": n_holes,
+        "seconds": best,
+        "instructions_per_second": instructions / best,
+        "us_per_hole": best / n_holes * 1e6 if n_holes else None,
+        "peak_kb": peak / 1024,
+    }
+
+def compare(result, baseline, tolerance, memory_tolerance):
+    # -> list of regressions beyond the tolerances (fractions); timings are
+    # noisy, peak memory is not
+    regressions = []
+    if result["instructions_per_second"] < baseline["instructions_per_second"] * (1 - tolerance):
+        regressions.append(f"{result['instructions_per_second'] / baseline['instructions_per_second']:.2f}x instructions/s")
+    if result["us_per_hole"] and baseline["us_per_hole"] and result["us_per_hole"] > baseline["us_per_hole"] * (1 + tolerance):
+        regressions.append(f"{result['us_per_hole'] / baseline['us_per_hole']:.2f}x us/hole")
+    if result["peak_kb"] > baseline["peak_kb"] * (1 + memory_tolerance):
+        regressions.append(f"{result['peak_kb'] / baseline['peak_kb']:.2f}x peak memory")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the silas interpreter on synthetic programs.")
+    parser.add_argument("--only", nargs="+", choices=sorted(benchmarks), help="Benchmarks to run (default: all)")
+    parser.add_argument("--sizes", nargs="+", type=int, help="Program sizes (default: per benchmark)")
+    parser.add_argument("--repeat", type=int, default=5, help="Minimum timed runs per program; the best one counts")
+    parser.add_argument("--min-time", type=float, default=0.2, metavar="SECONDS", help="Keep timing a program for at least this long")
+    parser.add_argument("--baseline", type=str, default=BASELINE_PATH, metavar="FILE", help="Baseline results")
+    parser.add_argument("--save", action="store_true", help="Store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="Slowdown reported as a regression (0.5: 1.5x slower)")
+    parser.add_argument("--memory-tolerance", type=float, default=0.1, help="Peak memory growth reported as a regression")
+    clargs = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(clargs.baseline):
+        with open(clargs.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressed = False
+    print(f"{'benchmark':<20} {'instructions':>12} {'instr/s':>12} {'us/hole':>9} {'peak KB':>9}")
+    for name in clargs.only or benchmarks:
+        generate, sizes = benchmarks[name]
+        for n in clargs.sizes or sizes:
+            key = f"{name}/{n}"
+            result = results[key] = measure(generate(n), clargs.repeat, clargs.min_time)
+            us_per_hole = f"{result['us_per_hole']:.1f}" if result["us_per_hole"] else "-"
+            line = f"{key:<20} {result['instructions']:>12} {result['instructions_per_second']:>12.0f} {us_per_hole:>9} {result['peak_kb']:>9.0f}"
+            if key in baseline and not clargs.save:
+                regressions = compare(result, baseline[key], clargs.tolerance, clargs.memory_tolerance)
+                if regressions:
+                    regressed = True
+                    line += silas.red("  regression: " + ", ".join(regressions))
+            print(line, flush=True)
+
+    if clargs.save:
+        baseline.update(results)
+        with open(clargs.baseline, "w") as f:
+            json.dump(baseline, f, indent=2)
+        print(f"saved {clargs.baseline}")
+
+    sys.exit(1 if regressed else 0)
+
+if __name__ == "__main__":
+    main()
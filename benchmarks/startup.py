@@ -0,0 +1,95 @@
+# startup time of the CLI, in milliseconds above a bare `python -c pass`,
+# and a check that importing silas leaves the heavy modules unloaded.
+#
+#   python benchmarks/startup.py          # run and compare with baseline.json
+#   python benchmarks/startup.py --save   # run and store a new baseline
+
+import argparse
+import json
+import os
+import py_compile
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+# over a bare interpreter; the point of the lazy imports
+TARGET_MS = 60
+
+# only imported by the runs that need them
+LAZY_MODULES = ["openai", "sqlite3", "http.client", "ssl", "concurrent.futures", "random"]
+
+def time_command(args, runs):
+    # -> median wall time in milliseconds
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(args, cwd=ROOT, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure silas startup time.")
+    parser.add_argument("--runs", type=int, default=20, help="Runs per command; the median counts")
+    parser.add_argument("--baseline", type=str, default=BASELINE_PATH, metavar="FILE", help="Baseline results")
+    parser.add_argument("--save", action="store_true", help="Store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="Slowdown reported as a regression")
+    clargs = parser.parse_args()
+
+    with tempfile.NamedTemporaryFile("w", suffix=".md", delete=False) as f:
+        f.write("> Say something: [x]\nreturn\n")
+        program = f.name
+
+    python = sys.executable
+    py_compile.compile(os.path.join(ROOT, "silas.py")) # bytecode cache, even under PYTHONDONTWRITEBYTECODE
+    bare = time_command([python, "-c", "pass"], clargs.runs)
+    commands = {
+        "import": [python, "-c", "import silas"],
+        "help": [python, "-m", "silas", "--help"],
+        "help_script": [python, "silas.py", "--help"],
+        "mock_run": [python, "-m", "silas", program, "--backend", "mock", "--mock-default", "hi"],
+    }
+
+    baseline = {}
+    if os.path.exists(clargs.baseline):
+        with open(clargs.baseline) as f:
+            baseline = json.load(f)
+
+    failed = False
+    print(f"{'startup':<20} {'ms':>8}   (bare interpreter: {bare:.1f} ms)")
+    results = {}
+    for name, args in commands.items():
+        key = f"startup/{name}"
+        ms = time_command(args, clargs.runs) - bare
+        results[key] = {"ms": ms}
+        line = f"{key:<20} {ms:>8.1f}"
+        if key in baseline and not clargs.save and ms > baseline[key]["ms"] * (1 + clargs.tolerance):
+            failed = True
+            line += f"  regression: {ms / baseline[key]['ms']:.2f}x"
+        print(line, flush=True)
+    os.remove(program)
+
+    if results["startup/import"]["ms"] > TARGET_MS:
+        failed = True
+        print(f"import takes {results['startup/import']['ms']:.1f} ms, over the {TARGET_MS} ms target")
+
+    check = f"import sys, silas; print(' '.join(m for m in {LAZY_MODULES!r} if m in sys.modules))"
+    loaded = subprocess.run([python, "-c", check], cwd=ROOT, check=True, capture_output=True, text=True).stdout.split()
+    if loaded:
+        failed = True
+        print(f"imported eagerly: {', '.join(loaded)}")
+
+    if clargs.save:
+        baseline.update(results)
+        with open(clargs.baseline, "w") as f:
+            json.dump(baseline, f, indent=2)
+        print(f"saved {clargs.baseline}")
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
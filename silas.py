@@ -1,9 +1,21 @@
 import argparse
-import importlib
-import inspect
 from dataclasses import dataclass
 import re
-import openai
+import os
+import json
+import time
+import sys
+import pickle
+import hashlib
+import math
+import io
+import threading
+from collections import OrderedDict, deque
+from bisect import bisect_left
+from array import array
+# the openai SDK, sqlite3, http.client, concurrent.futures and other modules
+# only some runs need are imported where they are first used, so that
+# starting the CLI stays cheap
 
 # TODO: argv input (for each? index? get length?)
 # - foreach <stack name> as if each one is pushed to one arg function
@@ -37,81 +49,352 @@ cyan = lambda text: f"\033[36m{text}\033[0m"
 white = lambda text: f"\033[37m{text}\033[0m"
 
 def load_functions(module_name):
-    module = importlib.import_module(module_name)
+    # primitives from a module name or a .py file; only functions defined
+    # there, with underscores spelled as dashes
+    import importlib
+    import importlib.util
+    import inspect
+    if module_name.endswith(".py"):
+        spec = importlib.util.spec_from_file_location(os.path.basename(module_name)[:-3], module_name)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    else:
+        if os.getcwd() not in sys.path:
+            sys.path.append(os.getcwd())
+        module = importlib.import_module(module_name)
     functions = inspect.getmembers(module, inspect.isfunction)
-    fct_dict = {name.replace('_', "-"): fct for name, fct in functions}
+    fct_dict = {name.replace('_', "-"): fct for name, fct in functions if fct.__module__ == module.__name__}
     return fct_dict
 
+def batch(fct):
+    # marks a primitive that works on plain python values: it is called with
+    # a list of the popped lines as str/int/float/bool (blocks as lists), and
+    # may return a list, a tuple, anything with tolist() (numpy arrays) or a
+    # single value
+    fct.batch = True
+    return fct
+
 
 # TYPES ##########################################;
 
 class Block:
-    def __init__(self, initial=None):
-        self.lines = []
-        self.index = -1
+    # lines are kept in two stacks around the cursor: head holds the lines
+    # before it in order, tail the lines after it in reverse, so pushing and
+    # popping at the cursor never shifts the rest of the block. The cursor
+    # is at the end (index -1) whenever tail is empty.
+    __slots__ = ("head", "tail", "rendered", "n_rendered", "offsets", "counts", "sink", "policy")
 
-        if initial:
+    def __init__(self, initial=None):
+        self.head = []
+        self.tail = []
+        self.sink = None # Sink that pushed lines are also written to
+        self.policy = None # context policy for holes filled in this block
+
+        # rendering of head[:n_rendered], extended lazily; pushes and pops at
+        # the cursor keep it, replacing head throws it away. offsets[i] is
+        # where line i starts in it and counts[i] the estimated tokens of
+        # head[:i], also extended lazily
+        self.rendered = ""
+        self.n_rendered = 0
+        self.offsets = [0]
+        self.counts = [0]
+
+        if initial is not None:
             self.push(initial)
 
+    @property
+    def lines(self):
+        return self.head + self.tail[::-1]
+
+    @property
+    def index(self):
+        return len(self.head) if self.tail else -1
+
     def push(self, x):
-        # x is a typed prompt object
+        # x is a typed prompt object, or a list of them
+        if self.sink is not None:
+            self.sink.write(x)
+            if not self.sink.keep:
+                return
 
         if isinstance(x, list):
-            self.lines += x
-            return
-
-        if not self.index == -1:
-            self.lines.insert(self.index, x)
-            self.index += 1
+            self.head += x
             return
 
-        self.lines.append(x)
+        self.head.append(x)
 
     def pop(self, n=1, pop_all=False):
-        # TODO: index MUST roll back to what came before popped segment
-        # there will be bugs when you start moving the pointer
-
         if pop_all:
-            if self.index == -1:
-                popped = self.lines
-                self.lines = []
-                return popped
-            popped = self.lines[:self.index]
-            del self.lines[:self.index]
-            popped = popped[0] if len(popped) == 1 else popped
-            self.index = 0
-            return popped
-
-        if self.index == -1:
-            popped = self.lines[-n:]
-            del self.lines[-n:]
-            popped = popped[0] if n == 1 else popped
+            popped = self.head
+            self.head = []
+            self.reset()
             return popped
 
-        popped = self.lines[self.index - n:self.index]
-        popped = popped[0] if len(popped) == 1 else popped
-        del self.lines[self.index - n:self.index]
+        if n == 0:
+            return []
 
-        return popped
+        popped = self.head[-n:]
+        del self.head[-n:]
+        self.truncate()
+        return popped[0] if n == 1 else popped
 
     def flip(self):
-        self.index = len(self.lines) - self.index - 1
-        self.lines.reverse()
+        # reverse the block; the cursor stays between the same two lines
+        self.head, self.tail = self.tail, self.head
+        self.reset()
 
     def select(self, index=-1):
-       self.index = index
+        if index == -1:
+            index = len(self)
+
+        moved = []
+        while len(self.head) > index:
+            moved.append(self.head.pop())
+        self.tail += moved
+        self.truncate()
+
+        while len(self.head) < index and self.tail:
+            self.head.append(self.tail.pop())
+
+    def reset(self):
+        self.rendered = ""
+        self.n_rendered = 0
+        self.offsets = [0]
+        self.counts = [0]
+
+    def truncate(self):
+        # lines came off the end of head
+        n = len(self.head)
+        if self.n_rendered > n:
+            self.rendered = self.rendered[:self.offsets[n]]
+            self.n_rendered = n
+            del self.offsets[n + 1:]
+        del self.counts[n + 1:]
+
+    def prompt(self):
+        # text before the cursor, i.e. what a completion continues from. The
+        # cache is only written by the thread that owns the block (pfor
+        # iterations copy outer blocks before reading them, see own_block);
+        # lines pushed meanwhile are picked up by the next call
+        n = len(self.head)
+        if self.n_rendered < n:
+            offsets = self.offsets
+            end = offsets[-1]
+            texts = [str(line) for line in self.head[self.n_rendered:n]]
+            for text in texts:
+                end += len(text)
+                offsets.append(end)
+            self.rendered += "".join(texts)
+            self.n_rendered = n
+        return self.rendered
+
+    def tokens(self):
+        # estimated tokens before the cursor; each line is counted once
+        counts = self.counts
+        for line in self.head[len(counts) - 1:len(self.head)]:
+            counts.append(counts[-1] + estimate_tokens(str(line)))
+        return counts[-1]
+
+    def context(self, policy=None):
+        # prompt() cut down by a context policy (see parse_policy)
+        text = self.prompt()
+        if policy is None:
+            return text
+
+        kind, a, b = policy
+        n = len(self.head)
+        if kind == "last":
+            return text[self.offsets[max(0, n - a)]:]
+        if kind == "tokens":
+            # newest lines that fit in a tokens
+            total = self.tokens()
+            return text[self.offsets[bisect_left(self.counts, total - a)]:]
+        # head a tail b
+        if a + b >= n:
+            return text
+        return text[:self.offsets[a]] + text[self.offsets[n - b]:]
+
+    def render(self):
+        if not self.tail:
+            return self.prompt()
+        return self.prompt() + "".join([str(line) for line in reversed(self.tail)])
 
     def __str__(self):
-        return "".join([str(line) for line in self.lines])
+        return self.render()
 
     def __getitem__(self, index):
-        return self.lines[index]
+        if isinstance(index, slice):
+            return self.lines[index]
+        if index < 0:
+            index += len(self)
+        if index < len(self.head):
+            return self.head[index]
+        if not 0 <= index < len(self):
+            raise IndexError("block index out of range")
+        return self.tail[len(self) - 1 - index]
 
     def __len__(self):
-        return len(self.lines)
+        return len(self.head) + len(self.tail)
+
+
+class StreamBlock:
+    # read-only block backed by a text file (one item per line), a jsonl file
+    # or stdin ("-"). for/pfor loops read it one item at a time from a byte
+    # offset, so only the current item is ever held in memory. Loops in pfor
+# iterations read it from other threads, so the file is read under a lock.
+
+    def __init__(self, path, format=None):
+        self.path = path
+        if format is None:
+            format = "jsonl" if path.endswith((".jsonl", ".ndjson")) else "lines"
+        self.format = format
+        self.file = None
+        self.position = 0
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # reopened where needed after a checkpoint is restored
+        return {"path": self.path, "format": self.format, "file": None, "position": 0}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def read(self, offset):
+        # -> (item, offset of the next item); item is None at the end
+        with self.lock:
+            line, offset = self.read_line(offset)
+        if line is None:
+            return None, offset
+
+        text = line.decode()
+        if self.format == "jsonl":
+            value = json.loads(text)
+            text = value if isinstance(value, str) else json.dumps(value)
+        return parse_arg(text), offset
+
+    def read_line(self, offset):
+        # -> (next non-blank line, offset after it), or (None, end offset)
+        if self.file is None:
+            self.file = sys.stdin.buffer if self.path == "-" else open(self.path, "rb")
+            self.position = 0
+
+        if self.position != offset:
+            assert self.path != "-", f"cannot seek in stdin"
+            self.file.seek(offset)
+            self.position = offset
+
+        line = b""
+        while not line.strip():
+            line = self.file.readline()
+            if not line:
+                return None, self.position
+            self.position += len(line)
+        return line, self.position
+
+    def items(self):
+        offset = 0
+        while True:
+            item, offset = self.read(offset)
+            if item is None:
+                return
+            yield item
+
+    def __str__(self):
+        return f"<{self.path}>\n"
+
+
+class Sink:
+    # jsonl file or stdout ("-") that the lines pushed to a block are
+    # appended to as they are produced. With keep=False the block itself
+    # stays empty, so a long run does not hold its results in memory.
+    # path=None writes to memory (see run_shard).
+
+    def __init__(self, path, keep=True):
+        self.path = path
+        self.keep = keep
+        self.file = None
+        self.position = 0 # bytes written
+
+    def __getstate__(self):
+        # a restored checkpoint reopens the file and cuts off whatever was
+        # written after it was saved
+        return {"path": self.path, "keep": self.keep, "file": None, "position": self.position}
+
+    def open(self):
+        if self.path is None:
+            self.file = io.BytesIO()
+            return
+        if self.path == "-":
+            self.file = sys.stdout.buffer
+            return
+        self.file = open(self.path, "ab")
+        self.file.truncate(self.position)
+
+    def write(self, x):
+        if self.file is None:
+            self.open()
+        items = x if isinstance(x, list) else [x]
+        self.append("".join(json.dumps(to_json(item)) + "\n" for item in items).encode())
+
+    def append(self, data):
+        # already encoded jsonl
+        if self.file is None:
+            self.open()
+        self.file.write(data)
+        self.file.flush()
+        self.position += len(data)
+
+    def close(self):
+        if self.path is None:
+            return # kept for getvalue()
+        if self.file is not None and self.path != "-":
+            self.file.close()
+        self.file = None
+
+
+def to_json(x):
+    # typed prompt object -> json value
+    if isinstance(x, Block):
+        return [to_json(line) for line in x.lines]
+    if isinstance(x, StreamBlock):
+        return x.path
+    if isinstance(x, Column):
+        return x.values.tolist()
+    return x.value
+
+
+class Column:
+    # read-only block of numbers packed in an array ('q' for ints, 'd' for
+    # floats): 8 bytes a line instead of an Int/Float object each. Pushed as
+    # one value by the column primitive, and understood by count, sum, mean
+    # and histogram (see numbers)
+
+    __slots__ = ("values",)
+
+    def __init__(self, values):
+        self.values = values
+
+    @property
+    def lines(self):
+        return [self[i] for i in range(len(self))]
+
+    def __getitem__(self, index):
+        value = self.values[index]
+        return Int(str(value)) if self.values.typecode == "q" else Float(repr(value))
+
+    def __len__(self):
+        return len(self.values)
+
+    def __str__(self):
+        if self.values.typecode == "q":
+            return "".join(f"{value}\n" for value in self.values)
+        return "".join(f"{value!r}\n" for value in self.values)
 
 
 class Line:
+    __slots__ = ("value",)
+
     def __init__(self, value:str):
         self.value = value
         if value.endswith("\n"):
@@ -121,6 +404,8 @@ class Line:
         return self.value + "\n"
 
 class Bool:
+    __slots__ = ("value",)
+
     def __init__(self, value:str):
         self.value = True if value.strip() == "True" else False
 
@@ -131,6 +416,8 @@ class Bool:
         return self.value
 
 class Int:
+    __slots__ = ("value",)
+
     def __init__(self, value:str):
         self.value = int(value)
 
@@ -138,6 +425,8 @@ class Int:
         return str(self.value) + "\n"
 
 class Float:
+    __slots__ = ("value",)
+
     def __init__(self, value:str):
         self.value = float(value)
 
@@ -145,13 +434,17 @@ class Float:
         return str(self.value) + "\n"
 
 
-# class Enum:
-#     def __init__(self, value:str, options:list[str]):
-#         self.value = value
-#         self.options = options
+class Enum:
+    # value of a choice hole, always one of its options
+    __slots__ = ("value", "options")
+
+    def __init__(self, value:str, options:list[str]):
+        assert value in options, f"{value} is not one of {options}"
+        self.value = value
+        self.options = options
 
-#     def __str__(self):
-#         return str(self.value) + "\n"
+    def __str__(self):
+        return str(self.value) + "\n"
 
 # TYPES ########################################;
 
@@ -163,6 +456,7 @@ class Frame:
     # blocks: dict[str, Block]
     lcl: dict
     block_stack: list[str]
+    memo_key: str = None # the result is memoized under this key on return
 
     def __str__(self):
         r = f"- {self.fct} "
@@ -176,6 +470,10 @@ class ForFrame:
     block_index: int
     iter_var: str
     iter_block: str
+    parallel: bool = False
+    offset: int = 0 # StreamBlock position of the next item
+    prefetched: int = 0 # items before this one have had their first hole prefetched
+    prefetch_offset: int = 0 # StreamBlock position of item `prefetched`
 
     def __str__(self):
         r = f"- {self.for_block_name.replace('_', ' ')} (iteration {self.block_index}) "
@@ -186,6 +484,10 @@ class ForFrame:
 # utils ####################
 def parse_arg(x: str):
     # transform string into typed prompt object
+    first = x[:1]
+    if first.isalpha() and first != "T" and first != "F":
+        return Line(x) # most text: cannot be a number or a bool
+
     x_stripped = x.strip()
 
     if x_stripped.isdigit():
@@ -194,12 +496,44 @@ def parse_arg(x: str):
         value = Float(x_stripped)
     elif x_stripped in ["True", "False"]:
         value = Bool(x_stripped)
-    # TODO: enums
+    # enums only come from choice holes, which know their options
     else:
         value = Line(x)
 
     return value
 
+def pick_option(text, options, top_logprobs=None):
+    # validate a completion into one of options: the option itself, one it
+    # was cut short from or ran on past, the option the likeliest first
+    # token starts, or the first option it mentions; ValueError otherwise
+    norm = lambda option: option.strip().lower()
+    text = norm(text)
+    for option in options:
+        if norm(option) == text:
+            return option
+
+    started = [option for option in options if text and norm(option).startswith(text)]
+    if len(started) == 1:
+        return started[0]
+    ran_on = [option for option in options if norm(option) and text.startswith(norm(option))]
+    if ran_on:
+        return max(ran_on, key=len)
+
+    if top_logprobs:
+        # probability of the first tokens each option could start with
+        scores = {}
+        for token, logprob in top_logprobs.items():
+            for option in options:
+                if norm(token) and norm(option).startswith(norm(token)):
+                    scores[option] = scores.get(option, 0.0) + math.exp(logprob)
+        if scores:
+            return max(scores, key=scores.get)
+
+    mentioned = [(text.find(norm(option)), option) for option in options if norm(option) and norm(option) in text]
+    if mentioned:
+        return min(mentioned)[1]
+    raise ValueError(f"completion '{text}' matches none of {options}")
+
 def dissect_prompt(s):
     result = []
     last_end = 0
@@ -218,538 +552,2050 @@ def dissect_prompt(s):
         result.append((s[last_end:].replace("\\[", "[").replace("\\]", "]").replace("\\{", "{").replace("\\}", "}"), "prompt"))
     return result
 
-def get_completion(input_string, stop=[]):
-
-    if not stop:
-        stop = ["\n"]
 
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "user", "content": input_string}
-        ],
-        stop=stop
-    )
-
-    return response['choices'][0]['message']['content']
+def from_python(x):
+    # primitive result -> typed prompt object, or a list of them
+    if hasattr(x, "tolist"):
+        x = x.tolist()
+    if isinstance(x, (list, tuple)):
+        return [to_line(value) for value in x]
+    return to_line(x)
+
+def to_line(x):
+    if isinstance(x, (Line, Int, Float, Bool, Enum, Block, Column)):
+        return x
+    if hasattr(x, "tolist"):
+        x = x.tolist()
+    if isinstance(x, (list, tuple)):
+        return Block([to_line(value) for value in x])
+    if isinstance(x, bool):
+        return Bool(str(x))
+    if isinstance(x, int):
+        return Int(str(x))
+    if isinstance(x, float):
+        return Float(repr(x))
+    return parse_arg(str(x))
+
+def copy_value(x):
+    # blocks are mutable, lines are not
+    return Block(x.lines) if isinstance(x, Block) else x
+
+# builtin primitives ####################
+# summaries of numeric lines without a loop in the program, e.g. "mean *"
+# in a block of ratings; functions of the program with the same name win
+
+NUMBER = re.compile(r"\s*(-?\d+(?:\.\d+)?)")
+
+def numbers(args):
+    # -> array of the numbers in typed lines: Int/Float/Bool values, the
+    # contents of Columns and Blocks, and the leading number of text lines
+    # ("7/10" counts as 7); lines without one are skipped
+    values = []
+    for arg in args if isinstance(args, list) else [args]:
+        if isinstance(arg, Column):
+            values.extend(arg.values)
+        elif isinstance(arg, Block):
+            values.extend(numbers(arg.lines))
+        elif isinstance(arg, (Int, Float, Bool)):
+            values.append(arg.value)
+        else:
+            match = NUMBER.match(str(arg))
+            if match:
+                text = match.group(1)
+                values.append(float(text) if "." in text else int(text))
+    try:
+        return array("q", values)
+    except (TypeError, OverflowError):
+        return array("d", values)
+
+def column(args):
+    return Column(numbers(args))
+
+def count(args):
+    return len(numbers(args))
+
+def sum_(args):
+    return sum(numbers(args))
+
+def mean(args):
+    values = numbers(args)
+    assert values, "mean: no numbers"
+    return sum(values) / len(values)
+
+def histogram(args):
+    # -> "value: count" lines, by value
+    counts = {}
+    for value in numbers(args):
+        counts[value] = counts.get(value, 0) + 1
+    return [f"{value}: {n}" for value, n in sorted(counts.items())]
+
+builtin_primitives = {"column": column, "count": count, "sum": sum_, "mean": mean, "histogram": histogram}
+
+def render_segments(segments, lcl):
+    # text of hole-free prompt/variable segments, rendered as fill_prompt does
+    out = []
+    for segment_type, value in segments:
+        if segment_type == "variable":
+            name, value = value, lcl[value]
+            assert not isinstance(value, StreamBlock), f"{{{name}}}: input block '{name}' is read lazily, iterate over it with for/pfor"
+            value = str(value) if isinstance(value, (Block, Column)) else str(value.value)
+        out.append(value)
+    return "".join(out)
+
+def estimate_tokens(text):
+    # rough local token count: words and punctuation marks
+    return len(re.findall(r"\w+|[^\w\s]", text))
+
+
+# BACKENDS #####################################
+# whatever turns a prompt into a completion; `model` is part of the cache key.
+# stream() yields the completion in pieces and may be closed early,
+# complete_batch() takes a list of (prompt, stop, max_tokens)
+
+class Backend:
+    model = None
+
+    def complete(self, prompt, stop, max_tokens=None):
+        raise NotImplementedError
+
+    def stream(self, prompt, stop, max_tokens=None):
+        yield self.complete(prompt, stop, max_tokens)
+
+    def choose(self, prompt, options, max_tokens=None):
+        # -> one of options, from a completion just long enough for the
+        # longest of them
+        n = max_tokens or max(1, max(estimate_tokens(option) for option in options))
+        return pick_option(self.complete(prompt, ["\n"], n), options)
+
+    def complete_batch(self, requests):
+        return [self.complete(*request) for request in requests]
+
+class OpenAIBackend(Backend):
+    def __init__(self, model="gpt-3.5-turbo", api_base=None):
+        self.model = model
+        self.api_base = api_base # e.g. a self-hosted OpenAI-compatible server
+
+    def request(self, prompt, stop, max_tokens, **kwargs):
+        import openai
+        if self.api_base:
+            kwargs["api_base"] = self.api_base
+        if max_tokens:
+            kwargs["max_tokens"] = max_tokens
+
+        return openai.ChatCompletion.create(
+            model=self.model,
+            messages=[
+                {"role": "user", "content": prompt}
+            ],
+            stop=stop,
+            **kwargs
+        )
+
+    def complete(self, prompt, stop, max_tokens=None):
+        response = self.request(prompt, stop, max_tokens)
+        return response['choices'][0]['message']['content']
+
+    def choose(self, prompt, options, max_tokens=None):
+        n = max_tokens or max(1, max(estimate_tokens(option) for option in options))
+        response = self.request(prompt, ["\n"], n, logprobs=True, top_logprobs=20)
+        choice = response['choices'][0]
+        return pick_option(choice['message']['content'], options, first_token_logprobs(choice))
+
+    def stream(self, prompt, stop, max_tokens=None):
+        response = self.request(prompt, stop, max_tokens, stream=True)
+        try:
+            for chunk in response:
+                content = chunk['choices'][0]['delta'].get('content')
+                if content:
+                    yield content
+        finally:
+            # drop the connection if the caller stopped early
+            if hasattr(response, "close"):
+                response.close()
+
+class MockBackend(Backend):
+    # offline stand-in for benchmarking: answers after a fixed latency with
+    # the first matching response, cut at the first stop token like a server
+    # would. responses are dicts with "completion" and either "prompt" (exact
+    # match) or "match" (regex searched in the prompt). Words count as tokens.
+
+    def __init__(self, responses=(), default="", latency=0.0, token_latency=0.0, model="mock"):
+        self.model = model
+        self.default = default
+        self.latency = latency # before the first token
+        self.token_latency = token_latency # between tokens when streaming
+        self.exact = {}
+        self.rules = []
+        for response in responses:
+            if "prompt" in response:
+                self.exact.setdefault(response["prompt"], response["completion"])
+            else:
+                self.rules.append((re.compile(response["match"]), response["completion"]))
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        # json list or jsonl
+        with open(path, "r") as f:
+            text = f.read()
+        if text.lstrip().startswith("["):
+            responses = json.loads(text)
+        else:
+            responses = [json.loads(line) for line in text.splitlines() if line.strip()]
+        return cls(responses, **kwargs)
+
+    def respond(self, prompt):
+        if prompt in self.exact:
+            return self.exact[prompt]
+        for pattern, completion in self.rules:
+            if pattern.search(prompt):
+                return completion
+        return self.default
+
+    def tokens(self, prompt, stop, max_tokens):
+        completion = self.respond(prompt)
+        for token in stop:
+            completion = completion.split(token, 1)[0]
+        tokens = re.findall(r"\s*\S+|\s+", completion)
+        return tokens[:max_tokens] if max_tokens else tokens
+
+    def complete(self, prompt, stop, max_tokens=None):
+        if self.latency:
+            time.sleep(self.latency)
+
+        tokens = self.tokens(prompt, stop, max_tokens)
+        if self.token_latency:
+            time.sleep(self.token_latency * len(tokens))
+        return "".join(tokens)
+
+    def stream(self, prompt, stop, max_tokens=None):
+        if self.latency:
+            time.sleep(self.latency)
+
+        for i, token in enumerate(self.tokens(prompt, stop, max_tokens)):
+            if i and self.token_latency:
+                time.sleep(self.token_latency)
+            yield token
+
+    def complete_batch(self, requests):
+        # one round trip for the whole batch
+        if self.latency:
+            time.sleep(self.latency)
+
+        batch = [self.tokens(*request) for request in requests]
+        if self.token_latency:
+            time.sleep(self.token_latency * max(len(tokens) for tokens in batch))
+        return ["".join(tokens) for tokens in batch]
+
+class BatchPending(Exception):
+    # completions missing from a batch results file; args[0] is the requests
+    # file, counted when the message is shown so it includes the requests
+    # written after this was raised (see open_parallel_for_loop)
 
-# primitives ################
+    def __str__(self):
+        path = self.args[0]
+        with open(path, "r") as f:
+            n = sum(1 for line in f if line.strip())
+        return f"{n} requests waiting in {path}"
+
+class BatchFileBackend(Backend):
+    # for offline batch endpoints (e.g. the OpenAI batch API): completions are
+    # read from a results file, and missing ones are appended to a requests
+    # file in the batch API's jsonl format, after which the run stops with
+    # BatchPending. Submit the requests, save the output as the results file
+    # and run again; every round gets further through the program.
+
+    def __init__(self, requests_path, results_path=None, model="gpt-3.5-turbo"):
+        self.model = model
+        self.requests_path = requests_path
+        self.results = {}
+        self.lock = threading.Lock()
+
+        if results_path and os.path.exists(results_path):
+            with open(results_path, "r") as f:
+                for line in f:
+                    if line.strip():
+                        result = json.loads(line)
+                        body = result["response"]["body"]
+                        self.results[result["custom_id"]] = body["choices"][0]["message"]["content"]
+
+        self.requested = set()
+        if os.path.exists(requests_path):
+            with open(requests_path, "r") as f:
+                self.requested = {json.loads(line)["custom_id"] for line in f if line.strip()}
+
+    def complete(self, prompt, stop, max_tokens=None):
+        return self.complete_batch([(prompt, stop, max_tokens)])[0]
+
+    def complete_batch(self, requests):
+        ids = [CompletionCache.key(self.model, *request) for request in requests]
+        missing = [(i, request) for i, request in zip(ids, requests) if i not in self.results]
+        if not missing:
+            return [self.results[i] for i in ids]
+
+        with self.lock, open(self.requests_path, "a") as f:
+            for custom_id, (prompt, stop, max_tokens) in missing:
+                if custom_id in self.requested:
+                    continue
+                self.requested.add(custom_id)
+                body = {"model": self.model, "messages": [{"role": "user", "content": prompt}], "stop": stop}
+                if max_tokens:
+                    body["max_tokens"] = max_tokens
+                f.write(json.dumps({"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": body}) + "\n")
+
+        raise BatchPending(self.requests_path)
+
+class RateLimiter:
+    # token buckets for requests/minute and tokens/minute, each holding up to
+    # a second's worth so a burst can't add to a minute's quota; acquire()
+    # blocks until both hold the cost (or a full bucket, for larger costs)
+    # and then pays all of it, so a large request delays the next ones
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.rates = (requests_per_minute, tokens_per_minute)
+        self.levels = [(rate or 0) / 60 for rate in self.rates]
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens):
+        costs = (1, tokens)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                wait = 0.0
+                for i, rate in enumerate(self.rates):
+                    if not rate:
+                        continue
+                    self.levels[i] = min(rate / 60, self.levels[i] + rate * (now - self.updated) / 60)
+                    cost = min(costs[i], rate / 60)
+                    if self.levels[i] < cost:
+                        wait = max(wait, (cost - self.levels[i]) * 60 / rate)
+                self.updated = now
+
+                if wait == 0.0:
+                    for i, rate in enumerate(self.rates):
+                        if rate:
+                            self.levels[i] -= costs[i]
+                    return
+            time.sleep(wait)
+
+class ConnectionPool:
+    # idle keep-alive connections to one host
+
+    def __init__(self, base_url, size=8, timeout=60.0):
+        import http.client
+        import urllib.parse
+        url = urllib.parse.urlsplit(base_url)
+        self.connection_class = http.client.HTTPSConnection if url.scheme == "https" else http.client.HTTPConnection
+        self.host = url.hostname
+        self.port = url.port
+        self.path = url.path.rstrip("/")
+        self.size = size
+        self.timeout = timeout
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def get(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        return self.connection_class(self.host, self.port, timeout=self.timeout)
+
+    def put(self, connection):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(connection)
+                return
+        connection.close()
+
+class HTTPBackend(Backend):
+    # OpenAI-compatible chat completions over pooled keep-alive connections,
+    # without the SDK. Connection errors, timeouts, 429 and 5xx responses are
+    # retried with exponential backoff and full jitter (or after Retry-After),
+    # and an optional rate limiter keeps requests and tokens under quota.
+
+    retry_status = {408, 409, 429, 500, 502, 503, 504}
+
+    def __init__(self, model="gpt-3.5-turbo", api_base="https://api.openai.com/v1", api_key=None,
+                 timeout=60.0, pool_size=8, retries=6, backoff=0.5, max_backoff=30.0, limiter=None):
+        self.model = model
+        self.pool = ConnectionPool(api_base, size=pool_size, timeout=timeout)
+        self.api_key = api_key or os.environ.get("OPENAI_API_KEY")
+        self.retries = retries
+        self.backoff = backoff # seconds, doubled on every attempt
+        self.max_backoff = max_backoff
+        self.limiter = limiter
+
+    def request(self, prompt, stop, max_tokens, stream=False, logprobs=False):
+        # -> (connection, response) with a 200 status; the caller reads the
+        # response and hands the connection back to the pool
+        from http.client import HTTPException
+        body = {"model": self.model, "messages": [{"role": "user", "content": prompt}], "stop": stop}
+        if max_tokens:
+            body["max_tokens"] = max_tokens
+        if stream:
+            body["stream"] = True
+        if logprobs:
+            body["logprobs"] = True
+            body["top_logprobs"] = 20
+        payload = json.dumps(body).encode()
+
+        headers = {"Content-Type": "application/json", "Connection": "keep-alive"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.wait(attempt, error)
+
+            if self.limiter is not None:
+                self.limiter.acquire(estimate_tokens(prompt) + (max_tokens or 16))
+
+            connection = self.pool.get()
+            try:
+                connection.request("POST", self.pool.path + "/chat/completions", body=payload, headers=headers)
+                response = connection.getresponse()
+            except (OSError, HTTPException) as e:
+                connection.close()
+                error = e
+                continue
+
+            if response.status == 200:
+                return connection, response
+
+            data = response.read()
+            self.pool.put(connection)
+            error = HTTPError(response.status, data.decode(errors="replace"), response.getheader("Retry-After"))
+            if response.status not in self.retry_status:
+                raise error
+
+        raise error
+
+    def wait(self, attempt, error):
+        retry_after = getattr(error, "retry_after", None)
+        try:
+            delay = float(retry_after)
+        except (TypeError, ValueError):
+            import random
+            delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+        time.sleep(delay)
+
+    def complete(self, prompt, stop, max_tokens=None):
+        connection, response = self.request(prompt, stop, max_tokens)
+        data = json.loads(response.read())
+        self.pool.put(connection)
+        return data["choices"][0]["message"]["content"]
+
+    def choose(self, prompt, options, max_tokens=None):
+        # a few tokens at most, plus the top logprobs of the first one so
+        # that a cut off or off-script answer still picks an option
+        n = max_tokens or max(1, max(estimate_tokens(option) for option in options))
+        connection, response = self.request(prompt, ["\n"], n, logprobs=True)
+        data = json.loads(response.read())
+        self.pool.put(connection)
+        choice = data["choices"][0]
+        return pick_option(choice["message"]["content"], options, first_token_logprobs(choice))
+
+    def stream(self, prompt, stop, max_tokens=None):
+        connection, response = self.request(prompt, stop, max_tokens, stream=True)
+        done = False
+        try:
+            for line in response:
+                line = line.strip()
+                if not line.startswith(b"data:"):
+                    continue
+                data = line[5:].strip()
+                if data == b"[DONE]":
+                    response.read()
+                    done = True
+                    break
+                content = json.loads(data)["choices"][0]["delta"].get("content")
+                if content:
+                    yield content
+        finally:
+            if done:
+                self.pool.put(connection)
+            else:
+                # stopped early: the rest of the stream is still on the wire
+                connection.close()
+
+def first_token_logprobs(choice):
+    # chat completion choice -> {token: logprob} of its first token, or None
+    content = (choice.get("logprobs") or {}).get("content")
+    if not content:
+        return None
+    return {top["token"]: top["logprob"] for top in content[0].get("top_logprobs", [])}
+
+class HTTPError(Exception):
+    def __init__(self, status, body, retry_after=None):
+        super().__init__(f"HTTP {status}: {body[:200]}")
+        self.status = status
+        self.retry_after = retry_after
+
+backends = {"openai": OpenAIBackend, "http": HTTPBackend, "mock": MockBackend, "batch": BatchFileBackend}
+
+
+class Batcher:
+    # groups completion requests from concurrent pfor iterations into
+    # backend.complete_batch calls of up to `size` requests; a partial batch
+    # is sent once it has waited `wait` seconds
+
+    def __init__(self, backend, size, wait=0.05):
+        self.backend = backend
+        self.size = size
+        self.wait = wait
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def complete(self, prompt, stop, max_tokens=None):
+        from concurrent.futures import Future
+        future = Future()
+        batch = None
+        with self.lock:
+            self.pending.append(((prompt, stop, max_tokens), future))
+            if len(self.pending) >= self.size:
+                batch, self.pending = self.pending, []
+            elif len(self.pending) == 1:
+                timer = threading.Timer(self.wait, self.flush)
+                timer.daemon = True
+                timer.start()
+
+        if batch:
+            self.send(batch)
+        return future.result()
+
+    def flush(self):
+        with self.lock:
+            batch, self.pending = self.pending, []
+        if batch:
+            self.send(batch)
+
+    def send(self, batch):
+        try:
+            completions = self.backend.complete_batch([request for request, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), completion in zip(batch, completions):
+            future.set_result(completion)
+
+
+# CACHE ########################################
+# completions keyed by (model, prompt, stop tokens); a small in-memory LRU in
+# front of an optional sqlite file that outlives the run
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "silas", "completions.sqlite")
+
+class CompletionCache:
+    def __init__(self, path=None, max_entries=4096, max_bytes=256 * 2**20):
+        self.path = path
+        self.max_entries = max_entries # in-memory layer
+        self.max_bytes = max_bytes # on-disk layer, prompts + completions
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self.db = None
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            import sqlite3
+            self.db = sqlite3.connect(path, timeout=30, check_same_thread=False) # shared by shard workers
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS completions "
+                "(key TEXT PRIMARY KEY, completion TEXT, size INTEGER, used REAL)"
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS completions_used ON completions (used)")
+            self.db.commit()
+            self.total = self.stored_bytes()
+            self.puts = 0
+
+    def stored_bytes(self):
+        # a full scan: the running total in put() is kept from this, and
+        # resynced now and then for the inserts of other processes
+        return self.db.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+
+    @staticmethod
+    def key(model, prompt, stop, max_tokens=None, options=None):
+        fields = [model, prompt, list(stop)]
+        if max_tokens:
+            fields.append(max_tokens)
+        if options:
+            fields.append({"options": list(options)})
+        return hashlib.sha256(json.dumps(fields).encode()).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return self.memory[key]
+
+            if self.db is not None:
+                row = self.db.execute("SELECT completion FROM completions WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    self.db.execute("UPDATE completions SET used = ? WHERE key = ?", (time.time(), key))
+                    self.db.commit()
+                    self.remember(key, row[0])
+                    self.hits += 1
+                    return row[0]
+
+            self.misses += 1
+            return None
+
+    def put(self, key, completion, size=0):
+        # size: bytes of the prompt behind key, charged against max_bytes
+        with self.lock:
+            self.remember(key, completion)
+
+            if self.db is None:
+                return
 
-def push(x):
-    global lcl
-    global block
+            size += len(completion.encode())
+            old = self.db.execute("SELECT size FROM completions WHERE key = ?", (key,)).fetchone()
+            self.db.execute(
+                "INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?)",
+                (key, completion, size, time.time())
+            )
+            self.total += size - (old[0] if old else 0)
+            self.puts += 1
+            if self.puts % 1024 == 0:
+                self.total = self.stored_bytes()
+            while self.total > self.max_bytes:
+                # evict least recently used
+                oldest = self.db.execute("SELECT key, size FROM completions ORDER BY used LIMIT 1").fetchone()
+                if oldest is None or oldest[0] == key:
+                    break
+                self.db.execute("DELETE FROM completions WHERE key = ?", (oldest[0],))
+                self.total -= oldest[1]
+            self.db.commit()
+
+    def remember(self, key, completion):
+        self.memory[key] = completion
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            if self.db is not None:
+                self.db.execute("DELETE FROM completions")
+                self.db.commit()
+                self.total = 0
+
+
+class LRU:
+    # bounded in-memory mapping that forgets the least recently used entries
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+class Tally:
+    # count that several threads add to
+
+    def __init__(self, n=0):
+        self.n = n
+        self.lock = threading.Lock()
+
+    def add(self, n=1):
+        with self.lock:
+            self.n += n
+
+
+# PROFILER #####################################
+# per line, per function and per hole counts and times; the time of a pfor
+# line includes all of its iterations, whose lines are also counted
+
+class Profiler:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+        self.lines = {} # pc -> [count, seconds]
+        self.functions = {} # name -> [calls, seconds]
+        self.holes = {} # (pc, name) -> [count, seconds, prompt tokens, completion tokens, cache hits]
+
+    def step(self, interpreter, instruction):
+        # the line's time goes to the function it is in, read before a call
+        # or return changes it
+        pc = interpreter.pc
+        fct = interpreter.function()
+        start = time.perf_counter()
+        interpreter.dispatch[instruction.op](interpreter, *instruction.args)
+        elapsed = time.perf_counter() - start
+
+        with self.lock:
+            stats = self.lines.setdefault(pc, [0, 0.0])
+            stats[0] += 1
+            stats[1] += elapsed
+            if instruction.op != "pfor":
+                self.functions.setdefault(fct, [0, 0.0])[1] += elapsed
+
+    def record_call(self, fct):
+        with self.lock:
+            self.functions.setdefault(fct, [0, 0.0])[0] += 1
+
+    def record_hole(self, pc, name, elapsed, prompt, completion, cached):
+        with self.lock:
+            stats = self.holes.setdefault((pc, name), [0, 0.0, 0, 0, 0])
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] += estimate_tokens(prompt)
+            stats[3] += estimate_tokens(completion)
+            stats[4] += cached
+
+    def report(self, program):
+        source = lambda pc: program.lines[pc].rstrip("\n")
+        return {
+            "seconds": time.perf_counter() - self.start,
+            "lines": sorted([
+                {"line": pc + 1, "source": source(pc), "count": count, "seconds": seconds}
+                for pc, (count, seconds) in self.lines.items()
+            ], key=lambda x: -x["seconds"]),
+            "functions": sorted([
+                {"function": fct, "calls": calls, "seconds": seconds}
+                for fct, (calls, seconds) in self.functions.items()
+            ], key=lambda x: -x["seconds"]),
+            "holes": sorted([
+                {"line": pc + 1, "hole": name, "count": count, "seconds": seconds,
+                 "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "cache_hits": hits}
+                for (pc, name), (count, seconds, prompt_tokens, completion_tokens, hits) in self.holes.items()
+            ], key=lambda x: -x["seconds"]),
+        }
+
+    def summary(self, report, top=10):
+        n_holes = sum(hole["count"] for hole in report["holes"])
+        hole_seconds = sum(hole["seconds"] for hole in report["holes"])
+        hits = sum(hole["cache_hits"] for hole in report["holes"])
+
+        out = [blue(f"= PROFILE ========================================")]
+        out.append(f"{report['seconds']:.3f}s total, {hole_seconds:.3f}s in {n_holes} completions ({hits} cached)")
+
+        out.append(cyan("- lines ------------------------------------------"))
+        out.append(f"{'seconds':>10} {'count':>8}  line")
+        for line in report["lines"][:top]:
+            out.append(f"{line['seconds']:>10.4f} {line['count']:>8}  {line['line']}: {line['source']}")
+
+        out.append(cyan("- functions --------------------------------------"))
+        out.append(f"{'seconds':>10} {'calls':>8}  function")
+        for fct in report["functions"][:top]:
+            out.append(f"{fct['seconds']:>10.4f} {fct['calls']:>8}  {fct['function']}")
+
+        out.append(cyan("- holes ------------------------------------------"))
+        out.append(f"{'seconds':>10} {'count':>8} {'prompt':>8} {'output':>8} {'cached':>8}  hole")
+        for hole in report["holes"][:top]:
+            out.append(
+                f"{hole['seconds']:>10.4f} {hole['count']:>8} {hole['prompt_tokens']:>8} "
+                f"{hole['completion_tokens']:>8} {hole['cache_hits']:>8}  {hole['line']}: [{hole['hole']}]"
+            )
+        return "\n".join(out)
 
-    x_strip = x.strip()
 
-    # if not x_strip in lcl:
-    x = parse_arg(x)
-    lcl[block].push(x)
-    return
+# SILAS ########################################
 
-    # lcl[block].push(lcl[x_strip])
+def parse_header(line):
+    # "# Name (memo)" -> ("Name", ["memo"])
+    name = line[2:].strip()
+    annotations = []
+    if name.endswith(")") and " (" in name:
+        name, _, annotations = name[:-1].partition(" (")
+        annotations = [annotation.strip() for annotation in annotations.split(",")]
+    return name.strip(), annotations
 
-def fill_prompt(prompt):
-    global lcl
+def preprocess(lines):
+    lines = [line.lstrip() for line in lines]
+    symbols = {} # label -> line number mappings
 
-    segments = dissect_prompt(prompt)
-    context = [str(lcl[block])]
-    filled = []
-    for segment, segment_type in segments:
-        stop_tokens = []
-        if segment_type == "hole":
-            if "|" in segment:
-                options = segment.split("|")
-                segment = options.pop(0)
-                for option in options:
-                    if option.startswith("*"):
-                        stop_tokens.append(option[1:])
-                        continue
-                    # TODO: other constraints]
-                    input(repr(option))
-                    raise Exception(f"Invalid hole constraint: {option}")
-
-            completion = get_completion("".join(context + filled), stop=stop_tokens)
-            filled.append(completion)
-            lcl[segment] = parse_arg(completion)
-
-        elif segment_type == "variable":
-            assert segment in lcl, f"(line {pc+1}) No local variable '{segment}'"
-            if isinstance(lcl[segment], Block):
-                filled.append(str(lcl[segment]))
-            else:
-                filled.append(str(lcl[segment].value))
-        else:
-            filled.append(segment)
+    # process labels and function definitions
+    i = 0
+    remaining_lines = len(lines)
+    # while remaining_lines > 0:
+    while i < len(lines):
+        remaining_lines -= 1
+        if lines[i].startswith("## "):
+            label = lines[i][3:].strip()
+            symbols[label] = i
+            # lines.pop(i)
+            i += 1
+            continue
+        if lines[i].startswith("# "):
+            name, _ = parse_header(lines[i])
+            # print(name)
+            symbols[name] = i
+            # lines.pop(i)
+            i += 1
+            continue
 
-    return "".join(filled)
+        # print(str(i) + " " + str(len(lines)))
+        i += 1
 
-def pop(n_and_var):
-    global lcl
-    global block
+    # input(f"RRETURNED ON {i}")
+    return lines, symbols
 
-    n_and_var = n_and_var.rstrip().split(" ")
 
-    n_pop_args = len(n_and_var)
-    pop_all = False
+# COMPILE ######################################
+# each source line is decoded once into an opcode plus operands; labels are
+# resolved to line numbers and prompts are pre-split, so the run loop never
+# touches the source text again
 
-    if n_pop_args == 0:
-        lcl[block].pop()
-        return
+@dataclass(slots=True)
+class Instruction:
+    op: str
+    args: tuple = ()
 
-    if n_pop_args == 1:
+def compile_prompt(s):
+    # pushed line -> ("prompt", text) / ("variable", name) / ("hole", name, stop_tokens, max_tokens, policy, options)
+    segments = []
+    for segment, segment_type in dissect_prompt(s):
+        if segment_type == "hole":
+            options = segment.split("|")
+            name = options.pop(0)
+            stop_tokens = []
+            max_tokens = None
+            policy = None
+            choices = []
+            for option in options:
+                if option.startswith("*"):
+                    stop_tokens.append(option[1:])
+                    continue
+                if option.startswith("#") and option[1:].isdigit():
+                    max_tokens = int(option[1:])
+                    continue
+                if option.startswith("@"):
+                    policy = parse_policy(option[1:])
+                    continue
+                if option.startswith("="):
+                    choices.append(option[1:])
+                    continue
+                # TODO: other constraints
+                raise Exception(f"Invalid hole constraint: {option}")
+            segments.append(("hole", name, stop_tokens, max_tokens, policy, tuple(choices) or None))
+        else:
+            segments.append((segment_type, segment))
+    return tuple(segments)
+
+def parse_policy(spec: str, pc=None):
+    # how much of a block a hole sees: "last N" lines, "tokens N" (the newest
+    # lines within an estimated N tokens) or "head N tail M" lines
+    where = f"(line {pc+1}) " if pc is not None else ""
+    words = spec.split()
+    assert all(word.isdigit() for word in words[1::2]), f"{where}context policy: expected numbers in '{spec}'"
+    if len(words) == 2 and words[0] in ("last", "tokens"):
+        return (words[0], int(words[1]), 0)
+    if len(words) == 4 and words[0] == "head" and words[2] == "tail":
+        return ("head", int(words[1]), int(words[3]))
+    raise Exception(f"{where}Invalid context policy: {spec}")
+
+def parse_pop(n_and_var: str, pc: int):
+    # -> (n, var, pop_all); var is None when popped lines are discarded
+    n_and_var = n_and_var.split()
+
+    if len(n_and_var) == 0:
+        return 1, None, False
+
+    if len(n_and_var) == 1:
         arg = n_and_var[0]
         if arg.isdigit():
-            n = int(arg)
-            lcl[block].pop(n)
-            return
+            return int(arg), None, False
 
         if arg == "*":
-            lcl[block].pop(pop_all=True)
-            return
+            return 1, None, True
 
         # otherwise the argument is a variable name, pop 1 from it
-        n_and_var = [1] + n_and_var
-        n_pop_args = 2
+        return 1, arg, False
 
-    if n_pop_args == 3:
+    if len(n_and_var) == 3:
         # for syntax like "pop 3 to block"
         assert n_and_var[1] == "to", f"(line {pc+1}) pop: for 3 arguments middle must be 'to' but was '{n_and_var[1]}'"
         n_and_var.pop(1)
-        n_pop_args = 2
 
-    if n_pop_args == 2:
+    if len(n_and_var) == 2:
         n, var = n_and_var
 
         if n == "to":
             # syntax like "pop to var"
-            n = 1
+            return 1, var, False
 
         if n == "*":
-            pop_all = True
-            n = 1 # ignored; n is overridden when pop_all
+            return 1, var, True # n is ignored when pop_all
 
-        if not isinstance(n, int):
-            assert n.isdigit(), f"(line {pc+1}) pop: {n} is not a number or 'to'"
-            n = int(n)
+        assert n.isdigit(), f"(line {pc+1}) pop: {n} is not a number or 'to'"
+        return int(n), var, False
 
-        if var in lcl:
-            # append to existing block
-            if isinstance(lcl[var], Block):
-                x = lcl[block].pop(n, pop_all=pop_all)
-                lcl[var].push(x)
-                return
-
-            assert n == 1, f"(line {pc+1}) pop: cannot pop more than 1 to non-block variable {var}"
+    raise Exception(f"(line {pc+1}) pop: too many arguments: {len(n_and_var)}")
 
-            # otherwise overwrite existing variable
-            lcl[var] = lcl[block].pop(n, pop_all=pop_all)
-            return
+def parse_call(fct_and_nargs: str, pc: int):
+    # -> (fct, nargs, pop_all)
+    # TODO: ability to define functions with fixed nargs
+    fct_and_nargs = fct_and_nargs.split()
 
-        # create new variable
-        if n > 1:
-            x = lcl[block].pop(n, pop_all=pop_all)
-            lcl[var] = Block(x)
-            return
+    if len(fct_and_nargs) == 1:
+        return fct_and_nargs[0], 0, False # if nargs isn't specified assume no args
 
-        val = lcl[block].pop(pop_all=pop_all)
+    if len(fct_and_nargs) == 2:
+        fct, nargs = fct_and_nargs
+        if nargs == "*":
+            return fct, 1, True
+        assert nargs.isdigit(), f"(line {pc+1}) call: expected number of arguments, got {nargs} in '{fct} {nargs}'"
+        return fct, int(nargs), False
 
-        if isinstance(val, list):
-            lcl[var] = Block(val)
-            return
+    raise Exception(f"(line {pc+1}) call: too many arguments to in call '{' '.join(fct_and_nargs)}'")
 
-        lcl[var] = val
+def resolve(symbol, symbols, pc):
+    assert symbol in symbols, f"(line {pc+1}) unknown label '{symbol}'"
+    return symbols[symbol]
 
-        return
+def parse_for(var_and_block: str, pc: int, keyword="for"):
+    var_and_block = var_and_block.split()
+    assert len(var_and_block) == 3, f"(line {pc+1}) {keyword}: expected the form '{keyword} x in y', got {' '.join(var_and_block)}"
+    iter_var, _, iter_block = var_and_block
+    return iter_var, iter_block, f"{keyword}_{iter_var}_in_{iter_block}"
 
-    raise Exception(f"(line {pc+1}) pop: too many arguments: {n_pop_args}")
+def compile_line(line, pc, symbols):
+    if line == "":
+        return Instruction("nop")
 
-def goto(symbol):
-    global pc
-    global symbols
-    symbol = symbol.strip()
-    pc = symbols[symbol] -1 # -1 because pc is incremented after each instruction
+    # bare keywords are whole words, so that primitives like debug-dump or
+    # pop-all are not taken for them
+    words = line.split(maxsplit=1)
+    keyword = words[0] if words else ""
 
-def if_goto(symbol):
-    global pc
-    global symbols
+    if line.startswith("> "):
+        # TODO: instead use {} to insert locals anywhere in line
+        return Instruction("push", (compile_prompt(line[2:]),))
 
-    symbol = symbol.strip()
+    if keyword == "pop":
+        return Instruction("pop", parse_pop(line[3:], pc))
 
-    do_jump = lcl[block].pop()
+    if line.startswith("goto "):
+        return Instruction("goto", (resolve(line[5:].strip(), symbols, pc),))
 
-    assert isinstance(do_jump, Bool), f"(line {pc+1}) if_goto: expected Bool but got {type(do_jump)}"
+    if line.startswith("if-goto "):
+        return Instruction("if-goto", (resolve(line[8:].strip(), symbols, pc),))
 
-    if do_jump:
-        pc = symbols[symbol] - 1
+    if line.startswith("call "):
+        fct, nargs, pop_all = parse_call(line[5:], pc)
+        return Instruction("call", (fct, symbols.get(fct), nargs, pop_all, False))
 
+    if keyword == "return":
+        return Instruction("return")
 
-def open_block(name):
-    global lcl
-    global block
-    global block_stack
+    if line.startswith("for "):
+        return Instruction("for", parse_for(line[4:], pc))
 
-    block_stack.append(block)
-    block = name
-    if not name in lcl:
-        lcl[block] = Block()
+    if line.startswith("pfor "):
+        return Instruction("pfor", parse_for(line[5:], pc, keyword="pfor"))
 
-    assert isinstance(lcl[block], Block), f"(line {pc+1}) block: cannot open {type(lcl[block])} as block"
+    if keyword == "endfor":
+        return Instruction("endfor")
 
-def close_block(name):
-    global lcl
-    global block
-    global block_stack
+    if line.startswith("</"):
+        # extract until >
+        parts = line[2:].split(">")
+        assert len(parts) == 2, f"(line {pc+1}) Closing block statement missing '>': {parts} "
+        return Instruction("close", (parts[0],))
 
-    assert block == name, f"(line {pc+1}) close block: expected </{name}> but got </{block}>"
+    if line.startswith("<"):
+        # extract until >
+        parts = line[1:].split(">")
+        assert len(parts) == 2, f"(line {pc+1}) Opening block statement missing '>': {parts} "
+        name, _, policy = parts[0].partition(" @")
+        return Instruction("open", (name, parse_policy(policy, pc) if policy else None))
+
+    if keyword == "debug":
+        return Instruction("debug")
+
+    if keyword == "break":
+        return Instruction("break")
+
+    if keyword == "exit":
+        return Instruction("exit")
+
+    if line.startswith("~") or line.startswith("#") or line.startswith(" "):
+        return Instruction("nop")
+
+    # primitives are only known to the interpreter, check them at runtime
+    return Instruction("primitive", (line,))
+
+def compile_program(lines, symbols):
+    code = [compile_line(line, i, symbols) for i, line in enumerate(lines)]
+
+    # pair loops with their endfor
+    open_loops = []
+    for i, instruction in enumerate(code):
+        if instruction.op in ("for", "pfor"):
+            open_loops.append(i)
+        elif instruction.op == "endfor":
+            assert open_loops, f"(line {i+1}) endfor: missing for statement"
+            j = open_loops.pop()
+            code[j].args = code[j].args + (i,)
+    assert not open_loops, f"(line {open_loops[-1]+1}) for: missing endfor"
+
+    # calls to functions declared "# Name (memo)"
+    for instruction in code:
+        if instruction.op == "call" and instruction.args[1] is not None:
+            if "memo" in parse_header(lines[instruction.args[1]])[1]:
+                instruction.args = instruction.args[:4] + (True,)
+
+    return code
+
+def plan_prefetch(code, start, end, iter_var):
+    # a for loop body code[start:end] whose first hole can be filled ahead of
+    # time: only pushes come before it, and they (and its own line) only use
+    # the loop variable and variables the body never assigns. Every
+    # iteration starts from an empty block, so the prompt is then known as
+    # soon as the item is. -> (segments of the lines pushed before the hole,
+    # segments of its line up to the hole) or None
+    written = set()
+    for instruction in code[start:end]:
+        op, args = instruction.op, instruction.args
+        if op == "push":
+            written.update(segment[1] for segment in args[0] if segment[0] == "hole")
+        elif op == "pop" and args[1] is not None:
+            written.add(args[1])
+        elif op in ("for", "pfor"):
+            written.update((args[0], args[2]))
+        elif op == "open":
+            written.add(args[0])
+
+    lines = []
+    for instruction in code[start:end]:
+        if instruction.op == "nop":
+            continue
+        if instruction.op != "push":
+            return None
+        segments = instruction.args[0]
+        for i, segment in enumerate(segments):
+            if segment[0] == "variable" and segment[1] != iter_var and segment[1] in written:
+                return None
+            if segment[0] == "hole":
+                return (lines, segments[:i + 1]) if segment[5] is None else None
+        lines.append(segments)
+    return None
 
-    block = block_stack.pop()
+@dataclass
+class Program:
+    # compiled source; read-only, so one Program can back many interpreters
+    lines: list[str]
+    symbols: dict[str, int]
+    code: list[Instruction]
+
+    @classmethod
+    def parse(cls, lines):
+        lines, symbols = preprocess(lines)
+        return cls(lines, symbols, compile_program(lines, symbols))
+
+
+class Interpreter:
+    def __init__(self, program, primitives=None, concurrency=8, cache=None, refresh_cache=False, backend=None, stream=False, batcher=None, profiler=None,
+                 checkpoint=None, checkpoint_every=10, inputs=None, sinks=None, prefetch=0, memo_size=1024):
+        if not isinstance(program, Program):
+            program = Program.parse(program)
+
+        self.program = program
+        self.code = program.code
+        self.primitives = {name: fct for name, fct in builtin_primitives.items() if name not in program.symbols}
+        self.primitives.update(primitives or {}) # python functions
+        self.concurrency = concurrency # pfor worker threads
+        self.slots = threading.Semaphore(concurrency) # completions in flight
+        self.backend = backend or OpenAIBackend()
+        self.cache = cache # CompletionCache or None
+        self.refresh_cache = refresh_cache # skip cache lookups, still store results
+        self.stream = stream # read completions token by token, stop client-side
+        self.batcher = batcher # Batcher for holes inside pfor loops
+        self.parallel = False # running a pfor iteration
+        self.profiler = profiler
+        self.checkpoint = checkpoint # path the run state is saved to
+        self.checkpoint_every = checkpoint_every # completions between checkpoints
+        self.completions = Tally() # completions requested, shared with pfor iterations
+        self.inputs = inputs or {} # name -> StreamBlock, visible in Main
+        self.sinks = sinks or {} # block name -> Sink
+        self.prefetch = prefetch # for loop iterations to fill the first hole of ahead of time
+        self.prefetcher = None # ThreadPoolExecutor, while running
+        self.prefetched = {} # (prompt, stop, max_tokens) -> Future of fetch_completion
+        self.prefetch_plans = {} # for pc -> plan_prefetch
+        self.memo = LRU(memo_size) # results of (memo) functions, shared with pfor iterations
+        self.verbose = False
+
+        self.pc = 0
+        self.block = "arg"
+        self.lcl = {"arg": Block()}
+        self.block_stack = []
+        self.call_stack = []
+
+        self.pfor_shared = {} # outer blocks not yet copied by this pfor iteration
+        self.pfor_owned = {} # block name -> (original, copy, original length)
+
+    def child(self):
+        # interpreter with the same program and configuration, sharing the
+        # completion slots and count
+        child = Interpreter(
+            self.program, self.primitives, self.concurrency, self.cache,
+            self.refresh_cache, self.backend, self.stream, self.batcher,
+            self.profiler
+        )
+        child.slots = self.slots
+        child.completions = self.completions
+        child.memo = self.memo
+        return child
+
+    @property
+    def n_completions(self):
+        return self.completions.n
+
+    @n_completions.setter
+    def n_completions(self, n):
+        self.completions.n = n
+
+    def get_completion(self, input_string, stop=[], max_tokens=None, hole=None, options=None):
+        if self.profiler is None:
+            return self.fetch_completion(input_string, stop, max_tokens, options=options)[0]
+
+        start = time.perf_counter()
+        completion, cached = self.fetch_completion(input_string, stop, max_tokens, options=options)
+        self.profiler.record_hole(self.pc, hole, time.perf_counter() - start, input_string, completion, cached)
+        return completion
+
+    def fetch_completion(self, input_string, stop, max_tokens, speculative=False, options=None):
+        # -> (completion, served from cache); with options, the completion
+        # is one of them
+        if not stop:
+            stop = ["\n"]
+
+        if self.prefetched and not speculative and not options:
+            future = self.prefetched.pop((input_string, tuple(stop), max_tokens), None)
+            if future is not None:
+                return future.result()
+
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(self.backend.model, input_string, stop, max_tokens, options)
+            if not self.refresh_cache:
+                completion = self.cache.get(key)
+                if completion is not None:
+                    return completion, True
+
+        self.completions.add()
+        with self.slots:
+            if options:
+                try:
+                    completion = self.backend.choose(input_string, list(options), max_tokens)
+                except ValueError as e:
+                    raise Exception(f"(line {self.pc+1}) choice hole: {e}") from e
+            elif self.batcher is not None and self.parallel:
+                completion = self.batcher.complete(input_string, stop, max_tokens)
+            elif self.stream and not speculative:
+                completion = self.stream_completion(input_string, stop, max_tokens)
+            else:
+                completion = self.backend.complete(input_string, stop, max_tokens)
+
+        if key is not None:
+            self.cache.put(key, completion, size=len(input_string.encode()))
+        return completion, False
+
+    def stream_completion(self, input_string, stop, max_tokens=None):
+        # stop tokens and max_tokens are also checked here, so the request is
+        # dropped as soon as the hole is decided whatever the server does
+        completion = ""
+        tokens = self.backend.stream(input_string, stop, max_tokens)
+        try:
+            for n, token in enumerate(tokens, 1):
+                scanned = len(completion)
+                completion += token
+
+                cut = len(completion)
+                for stop_token in stop:
+                    i = completion.find(stop_token, max(0, scanned - len(stop_token) + 1))
+                    if i != -1:
+                        cut = min(cut, i)
+
+                if self.verbose:
+                    print(yellow(completion[scanned:cut]), end="", flush=True)
+
+                if cut < len(completion):
+                    completion = completion[:cut]
+                    break
+                if max_tokens and n >= max_tokens:
+                    break
+        finally:
+            tokens.close()
+
+        if self.verbose:
+            print()
+        return completion
 
+    # primitives ################
 
-def call(fct_and_nargs: str, nargs: int=None):
+    def push(self, x):
+        x_strip = x.strip()
 
-    pop_all = False
+        # if not x_strip in lcl:
+        x = parse_arg(x)
+        self.lcl[self.block].push(x)
+        return
 
-    if nargs:
-        fct, nargs = fct_and_nargs.strip(), nargs
-    else:
-        fct_and_nargs = fct_and_nargs.split(" ")
-        if len(fct_and_nargs) == 1:
-            fct, nargs = fct_and_nargs[0].strip(), 0 # if nargs isn't specified assume no args
-        elif len(fct_and_nargs) == 2:
-            fct, nargs = fct_and_nargs
-            fct = fct.strip()
-            nargs = nargs.strip()
-            if not nargs == "*":
-                assert nargs.isdigit(), f"(line {pc+1}) call: expected number of arguments, got {nargs} in '{fct} {nargs}'"
-                nargs = int(nargs)
+        # lcl[block].push(lcl[x_strip])
+
+    def push_prompt(self, segments):
+        self.push(self.fill_prompt(segments))
+
+    def fill_prompt(self, segments):
+        lcl = self.lcl
+
+        block = lcl[self.block]
+        filled = []
+        for segment in segments:
+            segment_type = segment[0]
+            if segment_type == "hole":
+                _, name, stop_tokens, max_tokens, policy, options = segment
+                context = block.context(policy or block.policy)
+                prompt = context + "".join(filled)
+                completion = self.get_completion(prompt, stop=stop_tokens, max_tokens=max_tokens, hole=name, options=options)
+                filled.append(completion)
+                lcl[name] = Enum(completion, options) if options else parse_arg(completion)
+
+            elif segment_type == "variable":
+                name = segment[1]
+                assert name in lcl, f"(line {self.pc+1}) No local variable '{name}'"
+                if isinstance(lcl[name], (Block, Column)):
+                    if name in self.pfor_shared:
+                        self.own_block(name) # as it was when the pfor loop started
+                    filled.append(str(lcl[name]))
+                else:
+                    assert not isinstance(lcl[name], StreamBlock), f"(line {self.pc+1}) {{{name}}}: input block '{name}' is read lazily, iterate over it with for/pfor"
+                    filled.append(str(lcl[name].value))
             else:
-                assert nargs == "*",  f"(line {pc+1}) call: only '*' is supported for variable number of arguments"
-                nargs = 1
-                pop_all = True
-        else:
-            raise Exception(f"(line {pc+1}) call: too many arguments to in call '{fct_and_nargs}'")
+                filled.append(segment[1])
 
+        return "".join(filled)
 
-    # TODO: ability to define functions with fixed nargs
-    global call_stack
-    global block
-    global lcl
-    global block_stack
-
-    if isinstance(nargs, str):
-        nargs = nargs.strip()
-        if not nargs == "*":
-            assert nargs.isdigit(), f"(line {pc+1}) call: expected number of arguments, got {nargs}"
-            nargs = int(nargs.strip())
-        else:
-            assert nargs == "*",  f"(line {pc+1}) call: only '*' is supported for variable number of arguments"
-            nargs = 1
-            pop_all = True
-
-    args = lcl[block].pop(nargs, pop_all=pop_all)
-
-    if fct in primitives:
-        result = primitives[fct](args)
-        lcl[block].push(result)
-        return
+    def pop(self, n, var, pop_all):
+        lcl = self.lcl
+        block = self.block
+        pc = self.pc
 
-    frame = Frame(fct, pc, block, lcl, block_stack)
-    call_stack.append(frame)
-    block = "arg"
-    lcl = {"arg": Block(args)}
-    block_stack = []
-    goto(fct)
-
-def break_loop():
-    assert isinstance(call_stack[-1], ForFrame), f"(line {pc+1}) break: can only break out of loops"
-    frame = call_stack[-1]
-    close_for_loop()
-    goto(frame.close_pc)
-
-def return_ctrl():
-    global call_stack
-    global pc
-    global block
-    global lcl
-    global block_stack
-
-    frame = call_stack.pop()
-    pc = frame.pc
-    result = lcl[block] # fetch final state of called function
-    lcl = frame.lcl
-    block = frame.block
-    if len(result) == 1:
-        result = result[0]
-    lcl[block].push(result)
-    block_stack = frame.block_stack
-
-
-# TODO: open/clear/close block in for loop
-def open_for_loop(var_and_block):
-    global call_stack
-    global lcl
-    global pc
-
-    # make the language server happy
-    for_block_name = None
-    iter_var = None
-    iter_block = None
-
-    if isinstance(call_stack[-1], ForFrame) and call_stack[-1].close_pc is not None:
-        call_stack[-1].block_index += 1
-        lcl[call_stack[-1].for_block_name].pop(pop_all=True)
-    else:
-        for_block_name = "for_" + var_and_block.replace(" ", "_").rstrip()
-        open_block(for_block_name)
-        # lcl[block].pop(pop_all=True)
-        var_and_block = var_and_block.split(" ")
-        assert len(var_and_block) == 3, f"(line {pc+1}) for: expected the form 'for x in y', got {' '.join(var_and_block)}"
-
-        iter_var, _, iter_block = var_and_block
-        iter_block = iter_block.strip()
-
-        assert isinstance(lcl[iter_block], Block), f"(line {pc+1}) iterate: expected block, got {type(lcl[iter_block])}"
-        assert len(lcl[iter_block]) > 0, f"(line {pc+1}) for: block {iter_block} is empty"
-        call_stack.append(ForFrame(for_block_name, pc - 1, None, 0, iter_var, iter_block))
-
-    frame = call_stack[-1]
-    for_block_name = frame.for_block_name
-    block_index = frame.block_index
-    iter_var = frame.iter_var
-    iter_block = frame.iter_block
-
-    if block_index == len(lcl[iter_block]):
-        pc = frame.close_pc
-        call_stack.pop()
-        del lcl[iter_var]
-        close_block(for_block_name)
-        return
+        if var is None:
+            lcl[block].pop(n, pop_all=pop_all)
+            return
 
-    lcl[iter_var] = lcl[iter_block][block_index]
+        if var in lcl:
+            # append to existing block
+            if isinstance(lcl[var], Block):
+                self.own_block(var)
+                x = lcl[block].pop(n, pop_all=pop_all)
+                lcl[var].push(x)
+                return
 
-def close_for_loop():
-    global pc
-    global call_stack
-    assert isinstance(call_stack[-1], ForFrame), f"(line {pc+1}) endfor: missing for statement"
+            assert n == 1, f"(line {pc+1}) pop: cannot pop more than 1 to non-block variable {var}"
 
-    if not call_stack[-1].close_pc:
-        call_stack[-1].close_pc = pc
+            # otherwise overwrite existing variable
+            lcl[var] = lcl[block].pop(n, pop_all=pop_all)
+            return
 
-    # close_block(call_stack[-1].for_block_name)
-    pc = call_stack[-1].open_pc
+        # create new variable
+        if n > 1:
+            x = lcl[block].pop(n, pop_all=pop_all)
+            lcl[var] = Block(x)
+            return
 
+        val = lcl[block].pop(pop_all=pop_all)
 
-# SILAS ########################################
+        if isinstance(val, list):
+            lcl[var] = Block(val)
+            return
 
-call_stack = []
-heap = []
-primitives = {} # python functions
-symbols = {} # label -> line number mappings
-static = {}
+        lcl[var] = val
 
-pc = 0
-block = "arg"
-lcl = {"arg": Block()}
-block_stack = []
+    def goto(self, target):
+        self.pc = target - 1 # -1 because pc is incremented after each instruction
 
-def preprocess(lines):
-    global symbols
-    lines = [line.lstrip() for line in lines]
+    def if_goto(self, target):
+        do_jump = self.lcl[self.block].pop()
 
-    # process labels and function definitions
-    i = 0
-    remaining_lines = len(lines)
-    # while remaining_lines > 0:
-    while i < len(lines):
-        remaining_lines -= 1
-        if lines[i].startswith("## "):
-            label = lines[i][3:].strip()
-            symbols[label] = i
-            # lines.pop(i)
-            i += 1
-            continue
-        if lines[i].startswith("# "):
-            name = lines[i][2:].strip()
-            name = name.strip()
-            # print(name)
-            symbols[name] = i
-            # lines.pop(i)
-            i += 1
-            continue
+        assert isinstance(do_jump, Bool), f"(line {self.pc+1}) if_goto: expected Bool but got {type(do_jump)}"
 
-        # print(str(i) + " " + str(len(lines)))
-        i += 1
+        if do_jump:
+            self.pc = target - 1
 
-    # input(f"RRETURNED ON {i}")
-    return lines
 
-def execute_line(line):
-    global pc
+    def open_block(self, name, policy=None):
+        self.block_stack.append(self.block)
+        self.block = name
+        if not name in self.lcl:
+            self.lcl[name] = Block()
+            self.lcl[name].sink = self.sinks.get(name)
+        self.own_block(name)
 
-    if line == "":
-        return
+        assert isinstance(self.lcl[name], Block), f"(line {self.pc+1}) block: cannot open {type(self.lcl[name])} as block"
+        if policy is not None:
+            self.lcl[name].policy = policy
 
-    if line.startswith("> "):
-        # TODO: instead use {} to insert locals anywhere in line
-        line = line[2:]
-        line = fill_prompt(line)
-        push(line)
-        return
+    def close_block(self, name):
+        assert self.block == name, f"(line {self.pc+1}) close block: expected </{name}> but got </{self.block}>"
 
-    if line.startswith("pop"):
-        line = line[3:].lstrip()
-        pop(line)
-        return
+        self.block = self.block_stack.pop()
+        self.own_block(self.block)
 
-    if line.startswith("goto "):
-        line = line[5:]
-        goto(line)
-        return
 
-    if line.startswith("if-goto "):
-        line = line[8:]
-        if_goto(line)
-        return
+    def call(self, fct, target, nargs, pop_all, memo=False):
+        args = self.lcl[self.block].pop(nargs, pop_all=pop_all)
 
-    if line.startswith("call "):
-        line = line[5:]
-        call(line)
-        return
+        if fct in self.primitives:
+            primitive = self.primitives[fct]
+            if getattr(primitive, "batch", False):
+                result = primitive([to_json(arg) for arg in args] if isinstance(args, list) else [to_json(args)])
+            else:
+                result = primitive(args)
+            if result is not None:
+                self.lcl[self.block].push(from_python(result))
+            return
 
-    if line.startswith("return"):
-        return_ctrl()
-        return
+        assert target is not None, f"(line {self.pc+1}) call: unknown function '{fct}'"
 
-    if any(line.startswith(f"{x} ") for x in primitives):
-        call(line)
-        return
+        memo_key = None
+        if memo:
+            memo_key = self.memo_key(fct, args)
+            result = self.memo.get(memo_key)
+            if result is not None:
+                self.lcl[self.block].push(copy_value(result))
+                return
 
-    if line.startswith("for "):
-        line = line[4:]
-        open_for_loop(line)
-        return
+        if self.profiler is not None:
+            self.profiler.record_call(fct)
+
+        frame = Frame(fct, self.pc, self.block, self.lcl, self.block_stack, memo_key)
+        self.call_stack.append(frame)
+        self.block = "arg"
+        self.lcl = {"arg": Block(args)}
+        self.block_stack = []
+        self.goto(target)
+
+    @staticmethod
+    def memo_key(fct, args):
+        # function name and the type and text of every argument line
+        digest = hashlib.sha256(fct.encode())
+        for arg in args if isinstance(args, list) else [args]:
+            digest.update(f"\0{type(arg).__name__}\0{arg}".encode())
+        return digest.hexdigest()
+
+    def call_primitive(self, line):
+        fct = line.split(" ")[0]
+        if not fct in self.primitives or fct == line.rstrip():
+            raise Exception(f"(line {self.pc+1}) Unknown line: {line}")
+        fct, nargs, pop_all = parse_call(line, self.pc)
+        self.call(fct, None, nargs, pop_all)
+
+    def break_loop(self):
+        assert isinstance(self.call_stack[-1], ForFrame), f"(line {self.pc+1}) break: can only break out of loops"
+        assert not self.call_stack[-1].parallel, f"(line {self.pc+1}) break: cannot break out of a pfor loop"
+        frame = self.call_stack.pop()
+        del self.lcl[frame.iter_var]
+        self.close_block(frame.for_block_name)
+        self.pc = frame.close_pc
+
+    def return_ctrl(self):
+        frame = self.call_stack.pop()
+        self.pc = frame.pc
+        result = self.lcl[self.block] # fetch final state of called function
+        self.lcl = frame.lcl
+        self.block = frame.block
+        if len(result) == 1:
+            result = result[0]
+        if frame.memo_key is not None:
+            self.memo.put(frame.memo_key, copy_value(result))
+        self.lcl[self.block].push(result)
+        self.block_stack = frame.block_stack
+
+
+    # TODO: open/clear/close block in for loop
+    def open_for_loop(self, iter_var, iter_block, for_block_name, close_pc):
+        call_stack = self.call_stack
+        lcl = self.lcl
+        pc = self.pc
+
+        if isinstance(call_stack[-1], ForFrame) and call_stack[-1].open_pc == pc - 1:
+            # back from endfor
+            call_stack[-1].block_index += 1
+            lcl[for_block_name].pop(pop_all=True)
+        else:
+            self.open_block(for_block_name)
+            # lcl[block].pop(pop_all=True)
+            self.own_block(iter_block)
 
-    if line.startswith("endfor"):
-        close_for_loop()
-        return
+            if not isinstance(lcl[iter_block], StreamBlock):
+                assert isinstance(lcl[iter_block], (Block, Column)), f"(line {pc+1}) iterate: expected block, got {type(lcl[iter_block])}"
+                assert len(lcl[iter_block]) > 0, f"(line {pc+1}) for: block {iter_block} is empty"
+            call_stack.append(ForFrame(for_block_name, pc - 1, close_pc, 0, iter_var, iter_block))
 
-    if line.startswith("</"):
-        # extract until >
-        line = line[2:]
-        line = line.split(">")
-        assert len(line) == 2, f"(line {pc+1}) Closing block statement missing '>': {line} "
-        close_block(line[0])
-        return
+        frame = call_stack[-1]
 
-    if line.startswith("<"):
-        # extract until >
-        line = line[1:]
-        line = line.split(">")
-        assert len(line) == 2, f"(line {pc+1}) Opening block statement missing '>': {line} "
-        open_block(line[0])
-        return
-
-    if line.startswith("debug"):
-        print_stack()
-        return
+        if isinstance(lcl[iter_block], StreamBlock):
+            item, frame.offset = lcl[iter_block].read(frame.offset)
+        elif frame.block_index < len(lcl[iter_block]):
+            item = lcl[iter_block][frame.block_index]
+        else:
+            item = None
 
-    if line.startswith("break"):
-        break_loop()
-        return
+        if item is None:
+            self.pc = close_pc
+            call_stack.pop()
+            lcl.pop(iter_var, None)
+            self.close_block(for_block_name)
+            return
 
-    if line.startswith("exit"):
-        pc = -1
-        return
+        lcl[iter_var] = item
+        if self.prefetch and not self.parallel:
+            self.prefetch_iterations(frame)
+
+    def prefetch_iterations(self, frame):
+        # start the first hole of the next `prefetch` iterations now, if its
+        # prompt does not depend on what this iteration does (see plan_prefetch)
+        pc = frame.open_pc + 1
+        if pc not in self.prefetch_plans:
+            self.prefetch_plans[pc] = plan_prefetch(self.code, pc + 1, frame.close_pc, frame.iter_var)
+        plan = self.prefetch_plans[pc]
+        if plan is None:
+            return
 
-    if line.startswith("~"):
-        return
+        # only the items not prefetched by an earlier iteration
+        items = self.lcl[frame.iter_block]
+        first = frame.block_index + 1
+        start = max(frame.prefetched, first)
+        end = first + self.prefetch
+        if start >= end:
+            return
+        if isinstance(items, StreamBlock):
+            if items.path == "-":
+                return # can't read stdin twice
+            upcoming = []
+            offset = frame.prefetch_offset if frame.prefetched > first else frame.offset
+            while len(upcoming) < end - start:
+                item, offset = items.read(offset)
+                if item is None:
+                    break
+                upcoming.append(item)
+        else:
+            upcoming = [items[index] for index in range(start, min(end, len(items)))]
+
+        lines, segments = plan
+        _, _, stop, max_tokens, policy, _ = segments[-1]
+        stop = tuple(stop or ["\n"])
+        last = start + len(upcoming)
+        for index in range(start, last):
+            lcl = {**self.lcl, frame.iter_var: upcoming[index - start]}
+            block = Block()
+            try:
+                for line in lines:
+                    block.push(parse_arg(render_segments(line, lcl)))
+                text = render_segments(segments[:-1], lcl)
+            except (KeyError, AssertionError):
+                return # not defined yet, or left to fill_prompt to report
+            context = block.context(policy)
+            prompt = context + text
+
+            if (prompt, stop, max_tokens) not in self.prefetched:
+                if self.prefetcher is None:
+                    from concurrent.futures import ThreadPoolExecutor
+                    self.prefetcher = ThreadPoolExecutor(self.prefetch)
+                self.prefetched[(prompt, stop, max_tokens)] = self.prefetcher.submit(
+                    self.fetch_completion, prompt, list(stop), max_tokens, True
+                )
+        frame.prefetched = last
+        if isinstance(items, StreamBlock):
+            frame.prefetch_offset = offset
+
+    def close_for_loop(self):
+        assert isinstance(self.call_stack[-1], ForFrame), f"(line {self.pc+1}) endfor: missing for statement"
+
+        # close_block(call_stack[-1].for_block_name)
+        self.pc = self.call_stack[-1].open_pc
+
+
+    # parallel for ##############
+    # every pfor iteration runs on its own child interpreter on a worker
+    # thread; they share this interpreter's completion slots, so at most
+    # `concurrency` requests are in flight however loops are nested.
+    # Items are handed out lazily, a bounded window of iterations at a time.
+    # Outer blocks are copied (as they were when the loop started) the first
+    # time an iteration reads or writes them, and whatever it appended is
+    # merged back in source order as iterations finish; iterations never see
+    # the merges of the ones before them.
+
+    def own_block(self, name):
+        # copy-on-write for outer blocks inside a pfor iteration
+        if name in self.pfor_shared and self.lcl.get(name) is self.pfor_shared[name][0]:
+            original, n = self.pfor_shared.pop(name)
+            self.lcl[name] = Block(original[:n])
+            self.lcl[name].policy = original.policy
+            self.pfor_owned[name] = (original, self.lcl[name], n)
+
+    def run_iteration(self):
+        code = self.code
+        dispatch = self.dispatch
+        profiler = self.profiler
+        close_pc = self.call_stack[-1].close_pc
+        while self.pc != close_pc:
+            assert self.pc >= 0, f"pfor: exit is not allowed inside a parallel loop"
+            instruction = code[self.pc]
+            if profiler is None:
+                dispatch[instruction.op](self, *instruction.args)
+            else:
+                profiler.step(self, instruction)
+            self.pc += 1
+        return self
 
-    if line.startswith("#"):
-        return
+    def open_parallel_for_loop(self, iter_var, iter_block, for_block_name, close_pc):
+        self.own_block(iter_block)
+        lcl = self.lcl
+        pc = self.pc
 
-    if line.startswith(" "):
+        if isinstance(lcl[iter_block], StreamBlock):
+            items = lcl[iter_block].items()
+        else:
+            assert isinstance(lcl[iter_block], (Block, Column)), f"(line {pc+1}) iterate: expected block, got {type(lcl[iter_block])}"
+            assert len(lcl[iter_block]) > 0, f"(line {pc+1}) pfor: block {iter_block} is empty"
+            items = lcl[iter_block].lines
+
+        shared = {k: (v, len(v)) for k, v in lcl.items() if isinstance(v, Block)}
+
+        def spawn(i, item):
+            child = self.child()
+            child.parallel = True
+            child.pc = pc + 1
+            child.lcl = dict(lcl)
+            child.lcl[iter_var] = item
+            child.lcl[for_block_name] = Block()
+            child.block = for_block_name
+            child.block_stack = self.block_stack + [self.block]
+            # open_pc as for a sequential loop, so a for loop on the first line of the
+            # body is not mistaken for a return from its own endfor
+            child.call_stack = self.call_stack + [ForFrame(for_block_name, pc - 1, close_pc, i, iter_var, iter_block, parallel=True)]
+            child.pfor_shared = dict(shared)
+            return child
+
+        pending = None
+        def finish(future):
+            # with a batch file backend, keep going after the first missing
+            # completion so one round writes the requests of every iteration
+            nonlocal pending
+            try:
+                child = future.result()
+                if pending is None:
+                    self.merge(child) # the run stops at the end of the loop otherwise
+            except BatchPending as e:
+                pending = e
+
+        from concurrent.futures import ThreadPoolExecutor
+        window = deque()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for i, item in enumerate(items):
+                window.append(executor.submit(Interpreter.run_iteration, spawn(i, item)))
+                if len(window) >= 2 * self.concurrency:
+                    finish(window.popleft())
+            while window:
+                finish(window.popleft())
+        if pending is not None:
+            raise pending
+
+        self.pc = close_pc
+
+    def merge(self, child):
+        # appends of a finished pfor iteration to outer blocks
+        for name, (original, copy, n) in child.pfor_owned.items():
+            assert len(copy) >= n, f"(line {self.pc+1}) pfor: iterations may only append to outer block '{name}'"
+            if len(copy) > n:
+                self.own_block(name)
+                self.lcl[name].push(copy[n:])
+
+
+    def exit(self):
+        self.pc = -1
+
+    def nop(self, *args):
         return
 
-    raise Exception(f"(line {pc+1}) Unknown line: {line}")
-
+    dispatch = {
+        "nop": nop,
+        "push": push_prompt,
+        "pop": pop,
+        "goto": goto,
+        "if-goto": if_goto,
+        "call": call,
+        "return": return_ctrl,
+        "for": open_for_loop,
+        "pfor": open_parallel_for_loop,
+        "endfor": close_for_loop,
+        "open": open_block,
+        "close": close_block,
+        "debug": lambda self: self.print_stack(),
+        "break": break_loop,
+        "exit": exit,
+        "primitive": call_primitive,
+    }
+
+    def run(self, debug=False, verbose=False, resume=None):
+        self.verbose = verbose
+
+        if resume is not None:
+            self.restore(resume)
+        else:
+            self.pc = 0
+            self.block = "arg"
+            self.lcl = {"arg": Block(), **self.inputs}
+            self.block_stack = []
+            self.call_stack = [Frame("Main", -2, "arg", {"arg": Block()}, [])]
+            for sink in self.sinks.values():
+                sink.position = 0
+
+        for sink in self.sinks.values():
+            sink.open() # truncated to the start, or to the checkpoint
+
+        code = self.code
+        dispatch = self.dispatch
+        profiler = self.profiler
+        checkpointed = self.n_completions
+        while self.pc >= 0:
+            instruction = code[self.pc]
+            if profiler is None:
+                dispatch[instruction.op](self, *instruction.args)
+            else:
+                profiler.step(self, instruction)
+            self.pc += 1
+            if self.checkpoint and self.n_completions - checkpointed >= self.checkpoint_every:
+                self.save(self.checkpoint)
+                checkpointed = self.n_completions
+            if verbose:
+                self.print_stack()
+            if debug:
+                input("\n(CR to continue)")
+
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint) # finished, nothing to resume
+
+        for sink in self.sinks.values():
+            sink.close()
+
+        if self.prefetcher is not None:
+            self.prefetcher.shutdown(wait=False, cancel_futures=True)
+            self.prefetcher = None
+        self.prefetched = {}
+
+        return self.lcl[self.block]
+
+    # checkpoints ###############
+    # the whole run state between two instructions, pickled and swapped in
+    # atomically. A pfor loop is a single instruction, so a run interrupted
+    # inside one resumes from the start of the loop (use --cache to avoid
+    # paying again for its completions).
+
+    def save(self, path):
+        state = {
+            "lines": self.program.lines,
+            "pc": self.pc,
+            "lcl": self.lcl,
+            "block": self.block,
+            "block_stack": self.block_stack,
+            "call_stack": self.call_stack,
+            "n_completions": self.n_completions,
+            "sinks": self.sinks, # pickled with lcl so blocks keep pointing at them
+        }
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def restore(self, path):
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+
+        assert state["lines"] == self.program.lines, f"checkpoint {path} was saved from a different program"
+        self.pc = state["pc"]
+        self.lcl = state["lcl"]
+        self.block = state["block"]
+        self.block_stack = state["block_stack"]
+        self.call_stack = state["call_stack"]
+        self.n_completions = state["n_completions"]
+        self.sinks = state["sinks"]
+
+    def function(self):
+        # name of the function being executed
+        for frame in reversed(self.call_stack):
+            if isinstance(frame, Frame):
+                return frame.fct
+        return "Main"
+
+    def print_stack(self):
+        call_stack = self.call_stack
+        lcl = self.lcl
+        block = self.block
+
+        if len(call_stack) == 0:
+            return
 
-def run(lines, debug=False, verbose=False):
-    global pc
-    global call_stack
-    global primitives
+        print("\033c")
+        print(blue(f"= TRACE =========================================="))
 
-    lines = preprocess(lines)
+        prev_frame = call_stack[0]
+        for frame in call_stack[1:]:
+            print(prev_frame)
+            # print(frame.lcl)
+            if not isinstance(frame, ForFrame):
+                for line in frame.lcl[frame.block].lines:
+                    print(line)
 
-    call_stack.append(Frame("Main", -2, "arg", {"arg": Block()}, []))
+            prev_frame = frame
+        print(prev_frame)
+        print()
 
-    while pc >= 0:
-        line = lines[pc]
-        execute_line(line)
-        pc += 1
-        if verbose:
-            print_stack()
-        if debug:
-            input("\n(CR to continue)")
+        print(lcl[block])
+        if isinstance(call_stack[-1], ForFrame):
+            print(green("--------------------------------------------------"))
 
-    return lcl[block]
+        l = len(block) + 4
+        rem = 50 - l
+        s = "-"*(int(rem/2)) + f" [{block}] "
+        s = s + "-"*(50-len(s))
+        print(cyan(s))
+        print()
+        # print(str(lcl))
+
+
+        print(blue(f"= LOCALS ========================================="))
+        for var, val in lcl.items():
+            if var == block:
+                continue
+
+            val_type = str(type(val)).split("'")[1].split(".")[1]
+            s = f"- {var} ({val_type}) "
+            s = s + "-"*(50-len(s))
+            print(cyan(s))
+            if val:
+                print()
+                print(val, end="")
+                print()
+
+
+def run(lines, debug=False, verbose=False, resume=None, **options):
+    # options are Interpreter keyword arguments
+    return Interpreter(lines, **options).run(debug=debug, verbose=verbose, resume=resume)
+
+# SHARDING ########################################
+# for programs that treat every item of an input block independently: the
+# items are cut into shards of consecutive items, and worker processes run
+# the whole program once per shard, each with its own backend and cache
+# connection. Results come back in input order.
+
+shard_state = None # (program, interpreter options) in a worker process
+
+def init_shard_worker(program, clargs, inputs):
+    global shard_state
+    options = interpreter_options(clargs)
+    options["inputs"] = inputs
+    shard_state = (program, options)
+
+def run_shard(name, items, sink_names, keep):
+    # -> (lines of the final block, {block name: jsonl bytes})
+    program, options = shard_state
+    sinks = {sink: Sink(None, keep=keep) for sink in sink_names}
+    inputs = {**options["inputs"], name: Block(items)}
+    result = Interpreter(program, **{**options, "inputs": inputs, "sinks": sinks}).run()
+    return result.lines, {sink: sinks[sink].file.getvalue() for sink in sink_names if sinks[sink].file is not None}
+
+def run_sharded(program, clargs, inputs, name, path, workers, shard_size, sinks, keep=True):
+    # yields the results of run_shard for consecutive shards of the file at
+    # path, bound to block name; at most 2 * workers shards are in memory
+    def shards():
+        items = []
+        for item in StreamBlock(path).items():
+            items.append(item)
+            if len(items) == shard_size:
+                yield items
+                items = []
+        if items:
+            yield items
+
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(workers, initializer=init_shard_worker, initargs=(program, clargs, inputs)) as pool:
+        pending = deque()
+        for items in shards():
+            pending.append(pool.submit(run_shard, name, items, list(sinks), keep))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+# SERVE ########################################
+# a long-running process that answers JSON-RPC 2.0 requests, one json object
+# per line, on stdin/stdout or on a unix socket. Parsed programs, the backend
+# (with its connection pool), the completion cache and the completion slots
+# are shared by all requests, which run concurrently on a thread pool.
+#
+#   {"jsonrpc": "2.0", "id": 1, "method": "run",
+#    "params": {"program": "review.md", "inputs": {"reviews": ["good", "bad"]}}}
+#
+# "program" is a path (reparsed when it changes) or "source" the program text;
+# an input is a list of lines or the path of a text/jsonl file. The result is
+# {"result": [lines of the final block], "completions": n}.
+
+class Server:
+
+    def __init__(self, options, workers=8, programs=128):
+        from concurrent.futures import ThreadPoolExecutor
+        self.options = options
+        self.slots = threading.Semaphore(options["concurrency"]) # completions in flight, over all requests
+        self.programs = LRU(programs)
+        self.executor = ThreadPoolExecutor(workers)
+        self.queued = threading.Semaphore(4 * workers) # requests read ahead of the workers
+        self.lock = threading.Lock()
+        self.n_requests = 0
+        self.n_errors = 0
+
+    def program(self, params):
+        if "source" in params:
+            source = params["source"]
+            key = ("source", hashlib.sha256(source.encode()).hexdigest())
+        else:
+            assert "program" in params, "run: expected 'program' or 'source'"
+            path = os.path.abspath(params["program"])
+            key = ("path", path, os.path.getmtime(path))
+        program = self.programs.get(key)
+        if program is None:
+            if "source" in params:
+                lines = source.splitlines(keepends=True)
+            else:
+                with open(path, "r") as f:
+                    lines = f.readlines()
+            program = Program.parse(lines)
+            self.programs.put(key, program)
+        return program
+
+    def run(self, params):
+        inputs = {}
+        for name, value in params.get("inputs", {}).items():
+            if isinstance(value, str):
+                inputs[name] = StreamBlock(value)
+            else:
+                inputs[name] = Block([to_line(x) for x in value])
+        interpreter = Interpreter(self.program(params), inputs=inputs, **self.options)
+        interpreter.slots = self.slots
+        result = interpreter.run()
+        return {"result": to_json(result), "completions": interpreter.n_completions}
+
+    def stats(self, params):
+        cache = self.options["cache"]
+        return {
+            "requests": self.n_requests, "errors": self.n_errors, "programs": len(self.programs.entries),
+            "program_hits": self.programs.hits, "cache_hits": cache.hits if cache is not None else None,
+        }
+
+    methods = {"run": run, "stats": stats}
+
+    def respond(self, line):
+        # -> response for one request line, None for a notification
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            return {"jsonrpc": "2.0", "id": None, "error": {"code": -32700, "message": f"parse error: {e}"}}
+        if not isinstance(request, dict) or not isinstance(request.get("method"), str):
+            return {"jsonrpc": "2.0", "id": None, "error": {"code": -32600, "message": "invalid request"}}
+        request_id = request.get("id")
+        with self.lock:
+            self.n_requests += 1
+        method = self.methods.get(request["method"])
+        if method is None:
+            response = {"jsonrpc": "2.0", "id": request_id, "error": {"code": -32601, "message": f"unknown method '{request['method']}'"}}
+        else:
+            try:
+                response = {"jsonrpc": "2.0", "id": request_id, "result": method(self, request.get("params", {}))}
+            except Exception as e:
+                with self.lock:
+                    self.n_errors += 1
+                response = {"jsonrpc": "2.0", "id": request_id, "error": {"code": -32000, "message": f"{type(e).__name__}: {e}"}}
+        return response if "id" in request else None
+
+    def serve(self, lines, write):
+        # answers the requests in lines as they finish, not in order; returns
+        # once all of them are answered
+        from concurrent.futures import wait
+        lock = threading.Lock()
+        pending = set()
+
+        def handle(line):
+            try:
+                response = self.respond(line)
+                if response is not None:
+                    with lock:
+                        write(json.dumps(response) + "\n")
+            finally:
+                self.queued.release()
+
+        for line in lines:
+            if not line.strip():
+                continue
+            self.queued.acquire()
+            future = self.executor.submit(handle, line)
+            pending.add(future)
+            future.add_done_callback(pending.discard)
+        wait(list(pending))
+
+    def serve_stdio(self):
+        def write(data):
+            sys.stdout.write(data)
+            sys.stdout.flush()
+        self.serve(sys.stdin, write)
+
+    def serve_socket(self, path):
+        import socketserver
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                def write(data):
+                    self.wfile.write(data.encode())
+                    self.wfile.flush()
+                server.serve((line.decode() for line in self.rfile), write)
+
+        if os.path.exists(path):
+            os.remove(path)
+        with socketserver.ThreadingUnixStreamServer(path, Handler) as unix_server:
+            print(f"listening on {path}", file=sys.stderr)
+            try:
+                unix_server.serve_forever()
+            finally:
+                os.remove(path)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
 
 # CLI ########################################
 
-def print_stack():
-    if len(call_stack) == 0:
-        return
-
-    print("\033c")
-    print(blue(f"= TRACE =========================================="))
+def interpreter_options(clargs):
+    # backend, cache and concurrency settings from the command line
+    cache = None
+    if clargs.cache:
+        cache = CompletionCache(clargs.cache, max_bytes=clargs.cache_size * 2**20)
+
+    if clargs.backend == "mock":
+        mock_args = {"default": clargs.mock_default, "latency": clargs.mock_latency, "token_latency": clargs.mock_token_latency}
+        if clargs.model:
+            mock_args["model"] = clargs.model
+        if clargs.mock_responses:
+            backend = MockBackend.load(clargs.mock_responses, **mock_args)
+        else:
+            backend = MockBackend(**mock_args)
+    elif clargs.backend == "http":
+        backend = HTTPBackend(
+            clargs.model or "gpt-3.5-turbo", clargs.api_base or "https://api.openai.com/v1",
+            timeout=clargs.timeout, pool_size=clargs.max_concurrency, retries=clargs.retries,
+            limiter=RateLimiter(clargs.rpm, clargs.tpm) if clargs.rpm or clargs.tpm else None
+        )
+    elif clargs.backend == "batch":
+        backend = BatchFileBackend(clargs.batch_requests, clargs.batch_results, model=clargs.model or "gpt-3.5-turbo")
+    else:
+        backend = OpenAIBackend(clargs.model or "gpt-3.5-turbo", api_base=clargs.api_base)
 
-    prev_frame = call_stack[0]
-    for frame in call_stack[1:]:
-        print(prev_frame)
-        # print(frame.lcl)
-        if not isinstance(frame, ForFrame):
-            for line in frame.lcl[frame.block].lines:
-                print(line)
-
-        prev_frame = frame
-    print(prev_frame)
-    print()
-
-    print(lcl[block])
-    if isinstance(call_stack[-1], ForFrame):
-        print(green("--------------------------------------------------"))
-
-    l = len(block) + 4
-    rem = 50 - l
-    s = "-"*(int(rem/2)) + f" [{block}] "
-    s = s + "-"*(50-len(s))
-    print(cyan(s))
-    print()
-    # print(str(lcl))
-
-
-    print(blue(f"= LOCALS ========================================="))
-    for var, val in lcl.items():
-        if var == block:
-            continue
+    batcher = None
+    concurrency = clargs.max_concurrency
+    if clargs.batch_size:
+        batcher = Batcher(backend, clargs.batch_size, wait=clargs.batch_wait)
+        concurrency = max(concurrency, clargs.batch_size) # enough iterations to fill a batch
 
-        val_type = str(type(val)).split("'")[1].split(".")[1]
-        s = f"- {var} ({val_type}) "
-        s = s + "-"*(50-len(s))
-        print(cyan(s))
-        if val:
-            print()
-            print(val, end="")
-            print()
+    primitives = {}
+    for module_name in clargs.primitives:
+        primitives.update(load_functions(module_name))
 
+    return {
+        "primitives": primitives, "concurrency": concurrency, "cache": cache, "refresh_cache": clargs.refresh_cache,
+        "backend": backend, "stream": clargs.stream, "batcher": batcher, "prefetch": clargs.prefetch,
+        "memo_size": clargs.memo_size,
+    }
 
 def main():
     parser = argparse.ArgumentParser(description="Process some files.")
-    parser.add_argument("filename", type=str, help="Input filename")
+    parser.add_argument("filename", type=str, nargs="?", help="Input filename")
     parser.add_argument("-d", "--debug", action="store_true", help="Debug mode: pause at each line")
     parser.add_argument("-v", "--verbose", action="store_true", help="Verbose mode: print the prompt stack")
+    parser.add_argument("-j", "--max-concurrency", type=int, default=8, help="Maximum completions in flight for pfor loops")
+    parser.add_argument("--backend", choices=sorted(backends), default="openai", help="Completion backend")
+    parser.add_argument("--model", type=str, help="Model name (openai backend: gpt-3.5-turbo)")
+    parser.add_argument("--api-base", type=str, help="Base URL of an OpenAI-compatible server")
+    parser.add_argument("--timeout", type=float, default=60.0, metavar="SECONDS", help="Http backend: connect/read timeout")
+    parser.add_argument("--retries", type=int, default=6, help="Http backend: retries on connection errors, 429 and 5xx")
+    parser.add_argument("--rpm", type=int, help="Http backend: requests per minute limit")
+    parser.add_argument("--tpm", type=int, help="Http backend: tokens per minute limit")
+    parser.add_argument("--mock-responses", type=str, metavar="FILE", help="Mock backend: json/jsonl of {prompt|match, completion}")
+    parser.add_argument("--mock-default", type=str, default="", help="Mock backend: completion when nothing matches")
+    parser.add_argument("--mock-latency", type=float, default=0.0, metavar="SECONDS", help="Mock backend: delay before the first token")
+    parser.add_argument("--mock-token-latency", type=float, default=0.0, metavar="SECONDS", help="Mock backend: delay between tokens")
+    parser.add_argument("--stream", action="store_true", help="Stream completions and stop them client-side")
+    parser.add_argument("--batch-size", type=int, metavar="N", help="Send holes from pfor iterations to the backend in batches of up to N")
+    parser.add_argument("--batch-wait", type=float, default=0.05, metavar="SECONDS", help="How long a partial batch waits for more holes")
+    parser.add_argument("--batch-requests", type=str, default="batch_requests.jsonl", metavar="FILE", help="Batch backend: where missing requests are written")
+    parser.add_argument("--batch-results", type=str, default="batch_results.jsonl", metavar="FILE", help="Batch backend: results downloaded from the batch endpoint")
+    parser.add_argument("--primitives", action="append", default=[], metavar="MODULE", help="Register the functions of a python module (or .py file) as primitives")
+    parser.add_argument("--prefetch", type=int, default=0, metavar="N", help="Fill the first hole of the next N for loop iterations ahead of time when it does not depend on the current one")
+    parser.add_argument("--memo-size", type=int, default=1024, metavar="N", help="Results kept per run for functions declared '# Name (memo)'")
+    parser.add_argument("--profile", type=str, metavar="FILE", help="Write a json profile of lines, functions and holes, and print a summary")
+    parser.add_argument("--cache", nargs="?", const=DEFAULT_CACHE_PATH, metavar="PATH", help=f"Cache completions on disk (default path: {DEFAULT_CACHE_PATH})")
+    parser.add_argument("--cache-size", type=int, default=256, metavar="MB", help="Evict least recently used completions beyond this size")
+    parser.add_argument("--refresh-cache", action="store_true", help="Bypass cached completions but store the new ones")
+    parser.add_argument("--clear-cache", action="store_true", help="Empty the completion cache before running")
+    parser.add_argument("-i", "--input", action="append", default=[], metavar="NAME=FILE", help="Bind a block in Main to a text/jsonl file ('-' for stdin) read lazily by for loops")
+    parser.add_argument("-o", "--output", action="append", default=[], metavar="NAME=FILE", help="Append the lines pushed to block NAME to a jsonl file ('-' for stdout) as they are produced")
+    parser.add_argument("--drop-output", action="store_true", help="Do not keep the lines written to --output blocks in memory")
+    parser.add_argument("--shard-input", type=str, metavar="NAME=FILE", help="Split the block NAME, read from FILE, into shards run by worker processes")
+    parser.add_argument("--workers", type=int, help="Worker processes for --shard-input (default: one per cpu), or requests run at once by --serve (default: 8)")
+    parser.add_argument("--shard-size", type=int, default=32, metavar="N", help="Items per shard")
+    parser.add_argument("--serve", action="store_true", help="Answer JSON-RPC requests to run programs, one per line on stdin, until it closes")
+    parser.add_argument("--socket", type=str, metavar="PATH", help="With --serve: listen on a unix socket instead of stdin")
+    parser.add_argument("--checkpoint", type=str, metavar="FILE", help="Save the run state to FILE as it goes")
+    parser.add_argument("--checkpoint-every", type=int, default=10, metavar="N", help="Completions between checkpoints")
+    parser.add_argument("--resume", type=str, metavar="FILE", help="Continue from a checkpoint (and keep checkpointing to it)")
 
     clargs = parser.parse_args()
 
+    if clargs.clear_cache:
+        CompletionCache(clargs.cache or DEFAULT_CACHE_PATH).clear()
+
+    if clargs.serve:
+        server = Server(interpreter_options(clargs), workers=clargs.workers or 8)
+        try:
+            if clargs.socket:
+                server.serve_socket(clargs.socket)
+            else:
+                server.serve_stdio()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+        return
+
+    if clargs.filename is None:
+        if not clargs.clear_cache:
+            parser.error("the following arguments are required: filename")
+        return
+
     file = clargs.filename
     with open(file, "r") as f:
         lines = f.readlines()
@@ -760,9 +2606,64 @@ def main():
     if debug:
         verbose = True
 
-    run(lines, debug=debug, verbose=verbose)
+    program = Program.parse(lines)
+    profiler = Profiler() if clargs.profile else None
+
+    checkpoint = clargs.checkpoint or clargs.resume
+
+    inputs = {}
+    for binding in clargs.input:
+        name, _, path = binding.partition("=")
+        assert path, f"--input: expected NAME=FILE, got '{binding}'"
+        inputs[name] = StreamBlock(path)
+
+    sinks = {}
+    for binding in clargs.output:
+        name, _, path = binding.partition("=")
+        assert path, f"--output: expected NAME=FILE, got '{binding}'"
+        sinks[name] = Sink(path, keep=not clargs.drop_output)
+
+    quiet = any(sink.path == "-" for sink in sinks.values()) # results already on stdout
+
+    if clargs.shard_input:
+        if debug or profiler or checkpoint:
+            parser.error("--shard-input cannot be combined with -d, -v, --profile or checkpoints")
+        name, _, path = clargs.shard_input.partition("=")
+        assert path, f"--shard-input: expected NAME=FILE, got '{clargs.shard_input}'"
+        for sink in sinks.values():
+            sink.open()
+        shards = run_sharded(program, clargs, inputs, name, path, clargs.workers or os.cpu_count(), clargs.shard_size, sinks, keep=not clargs.drop_output)
+        for lines, sunk in shards:
+            for sink, data in sunk.items():
+                sinks[sink].append(data)
+            if not quiet:
+                print("".join(str(line) for line in lines), end="", flush=True)
+        for sink in sinks.values():
+            sink.close()
+        return
+
+    try:
+        result = run(
+            program, debug=debug, verbose=verbose, resume=clargs.resume,
+            profiler=profiler, checkpoint=checkpoint, checkpoint_every=clargs.checkpoint_every,
+            inputs=inputs, sinks=sinks, **interpreter_options(clargs)
+        )
+        if not quiet:
+            print(result, end="")
+    except BatchPending as e:
+        print(f"{e}; submit them and save the output to {clargs.batch_results}, then run again", file=sys.stderr)
+    except KeyboardInterrupt:
+        if checkpoint and os.path.exists(checkpoint):
+            print(f"interrupted; continue with --resume {checkpoint}", file=sys.stderr)
+        else:
+            raise
+    finally:
+        if profiler is not None:
+            report = profiler.report(program)
+            with open(clargs.profile, "w") as f:
+                json.dump(report, f, indent=2)
+            print(profiler.summary(report), file=sys.stderr)
 
 if __name__ == "__main__":
     main()
 
-
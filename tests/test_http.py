@@ -0,0 +1,150 @@
+# checks of the http backend against a local stub of the chat completions
+# endpoint; run with
+#
+#   python -m pytest tests
+
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import silas
+
+
+class Stub(BaseHTTPRequestHandler):
+    # answers each request with the next scripted action of the server:
+    #   ("ok", content, logprobs)  a chat completion
+    #   ("stream", tokens)         the tokens as server-sent events
+    #   (status, headers)          an error response
+    #   "drop"                     closes the connection without answering
+    # and records (client port, request body)
+    protocol_version = "HTTP/1.1" # keep-alive
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with self.server.lock:
+            self.server.requests.append((self.client_address[1], body))
+            action = self.server.script.pop(0) if self.server.script else ("ok", "fine", None)
+
+        if action == "drop":
+            self.close_connection = True
+            return
+        if action[0] == "ok":
+            choice = {"message": {"role": "assistant", "content": action[1]}}
+            if action[2]:
+                top = [{"token": token, "logprob": logprob} for token, logprob in action[2].items()]
+                choice["logprobs"] = {"content": [{"token": action[1], "top_logprobs": top}]}
+            self.send(200, json.dumps({"choices": [choice]}).encode(), {"Content-Type": "application/json"})
+        elif action[0] == "stream":
+            events = [{"choices": [{"delta": {"content": token}}]} for token in action[1]]
+            data = "".join(f"data: {json.dumps(event)}\n\n" for event in events) + "data: [DONE]\n\n"
+            self.send(200, data.encode(), {"Content-Type": "text/event-stream"})
+        else:
+            status, headers = action
+            self.send(status, b'{"error": "scripted"}', headers)
+
+    def send(self, status, data, headers):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Stub)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.requests = []
+    server.script = []
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def backend(stub, **options):
+    return silas.HTTPBackend("stub-model", stub.url, api_key="key", backoff=0.001, timeout=5, **options)
+
+
+def test_complete_reuses_connection(stub):
+    http = backend(stub)
+    stub.script = [("ok", "one", None), ("ok", "two", None), ("ok", "three", None)]
+    assert [http.complete(f"prompt {i}", ["\n"], 5) for i in range(3)] == ["one", "two", "three"]
+
+    ports = {port for port, _ in stub.requests}
+    assert len(ports) == 1
+    body = stub.requests[1][1]
+    assert body["model"] == "stub-model"
+    assert body["messages"] == [{"role": "user", "content": "prompt 1"}]
+    assert body["stop"] == ["\n"] and body["max_tokens"] == 5
+
+
+def test_retries_transient_errors(stub):
+    stub.script = [(503, {}), (429, {"Retry-After": "0"}), "drop", ("ok", "done", None)]
+    assert backend(stub).complete("prompt", ["\n"]) == "done"
+    assert len(stub.requests) == 4
+
+
+def test_no_retry_on_client_error(stub):
+    stub.script = [(400, {})]
+    with pytest.raises(silas.HTTPError) as error:
+        backend(stub).complete("prompt", ["\n"])
+    assert error.value.status == 400
+    assert len(stub.requests) == 1
+
+
+def test_gives_up_after_retries(stub):
+    stub.script = [(503, {})] * 3
+    with pytest.raises(silas.HTTPError) as error:
+        backend(stub, retries=2).complete("prompt", ["\n"])
+    assert error.value.status == 503
+    assert len(stub.requests) == 3
+
+
+def test_stream_stops_at_stop_token(stub):
+    stub.script = [("stream", ["Hel", "lo. More", " text"])]
+    lines = ["> Say: [x|*.]\n", "return\n"]
+    result = silas.Interpreter(lines, backend=backend(stub), stream=True).run()
+    assert str(result) == "Say: Hello\n"
+    assert stub.requests[0][1]["stream"] is True
+
+
+def test_choose_uses_first_token_logprobs(stub):
+    stub.script = [("ok", "maybe", {"ne": -0.2, "po": -1.5, "neutral": -3.0})]
+    assert backend(stub).choose("Sentiment:", ["pos", "neg"]) == "neg"
+    assert stub.requests[0][1]["top_logprobs"] == 20
+
+
+def test_pfor_through_pool(stub):
+    items = "".join(f"> item {i}\n" for i in range(12))
+    lines = ["<items>\n", *items.splitlines(keepends=True), "</items>\n",
+             "<out>\n", "pfor x in items\n", "        > Rate {x}: [r]\n", "    <out>\n", "        > {r}\n", "    </out>\n", "endfor\n", "return\n"]
+    result = silas.Interpreter(lines, backend=backend(stub, pool_size=4), concurrency=4).run()
+    assert str(result) == "fine\n" * 12
+    assert len(stub.requests) == 12
+    assert len({port for port, _ in stub.requests}) <= 4
+
+
+def test_rate_limiter_waits_for_tokens():
+    limiter = silas.RateLimiter(tokens_per_minute=600) # 10 a second, at most 10 at once
+    start = time.monotonic()
+    limiter.acquire(10)
+    assert time.monotonic() - start < 0.1
+    limiter.acquire(5)
+    assert time.monotonic() - start >= 0.4
+    limiter.acquire(20) # more than the bucket holds, paid in full
+    limiter.acquire(1)
+    assert time.monotonic() - start >= 1.9
@@ -0,0 +1,595 @@
+# checks of the interpreter against the mock backend; run with
+#
+#   python -m pytest tests
+
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+import silas
+
+
+def run(source, default="7", **options):
+    # -> text of the final block
+    backend = options.pop("backend", None) or silas.MockBackend(default=default)
+    resume = options.pop("resume", None)
+    lines = [line + "\n" for line in source.strip("\n").split("\n")]
+    return str(silas.Interpreter(lines, backend=backend, **options).run(resume=resume))
+
+
+class EchoBackend(silas.Backend):
+    # completes with the next to last word of the prompt, after a delay that
+    # shuffles the order concurrent requests finish in; raises
+    # KeyboardInterrupt after `interrupt_after` completions
+    model = "echo"
+
+    def __init__(self, interrupt_after=None):
+        import random
+        self.random = random.Random(0)
+        self.interrupt_after = interrupt_after
+        self.n = 0
+
+    def complete(self, prompt, stop, max_tokens=None):
+        import time
+        self.n += 1
+        if self.interrupt_after is not None and self.n > self.interrupt_after:
+            raise KeyboardInterrupt
+        time.sleep(self.random.uniform(0, 0.005))
+        return prompt.split()[-2].upper()
+
+ITEMS = """
+<items>
+> a
+> b
+> c
+</items>
+"""
+
+# loops ########################################
+
+def test_pfor_keeps_source_order():
+    items = "\n".join(f"> item{i}" for i in range(40))
+    program = f"""
+<items>
+{items}
+</items>
+<out>
+pfor x in items
+        > Say {{x}}
+        > Then: [y]
+    <out>
+        > {{y}}
+    </out>
+endfor
+return
+"""
+    expected = "".join(f"ITEM{i}\n" for i in range(40))
+    assert run(program, backend=EchoBackend(), concurrency=8) == expected
+    assert run(program, backend=EchoBackend()) == expected
+
+
+def test_nested_for_in_pfor():
+    program = ITEMS + """
+<out>
+pfor x in items
+for y in items
+    <out>
+        > {x}{y}
+    </out>
+endfor
+endfor
+return
+"""
+    expected = "".join(f"{x}{y}\n" for x in "abc" for y in "abc")
+    assert run(program) == expected
+
+
+def test_nested_for_in_pfor_after_same_loop():
+    # a for loop with the same name already ran in the enclosing scope
+    program = ITEMS + """
+<out>
+for y in items
+endfor
+pfor x in items
+for y in items
+    <out>
+        > {x}{y}
+    </out>
+endfor
+endfor
+return
+"""
+    expected = "".join(f"{x}{y}\n" for x in "abc" for y in "abc")
+    assert run(program) == expected
+
+def test_nested_loops_over_stream_input(tmp_path):
+    # pfor iterations and their for loops read the same file from threads
+    path = tmp_path / "nums.txt"
+    path.write_text("".join(f"{i}\n" for i in range(40)))
+    program = """
+<out>
+pfor x in nums
+for y in nums
+    <out>
+        > {x} {y}
+    </out>
+endfor
+endfor
+return
+"""
+    expected = "".join(f"{x} {y}\n" for x in range(40) for y in range(40))
+    for _ in range(5):
+        assert run(program, inputs={"nums": silas.StreamBlock(str(path))}) == expected
+
+def test_pfor_reads_outer_blocks_as_at_loop_start():
+    # merges of finished iterations are not visible to running ones
+    items = "\n".join(f"> item{i}" for i in range(20))
+    program = f"""
+<items>
+{items}
+</items>
+<out>
+> start
+pfor x in items
+        > So far: {{out}}
+        > {{x}} then: [y]
+    <out>
+        > {{y}}
+    </out>
+endfor
+return
+"""
+    for _ in range(3):
+        backend = EchoBackend()
+        prompts = []
+        complete = backend.complete
+        backend.complete = lambda prompt, stop, max_tokens=None: prompts.append(prompt) or complete(prompt, stop, max_tokens)
+        assert run(program, backend=backend, concurrency=2) == "start\n" + "".join(f"ITEM{i}\n" for i in range(20))
+        assert len(prompts) == 20
+        assert all(prompt.startswith("So far: start\n") and "ITEM" not in prompt for prompt in prompts)
+
+def test_pfor_keeps_render_cache_of_outer_blocks():
+    # the cached prompt of a block that iterations read while it is merged
+    # into still matches its lines
+    items = "\n".join(f"> item{i}" for i in range(300))
+    program = f"""
+<items>
+{items}
+</items>
+<out>
+> start
+pfor x in items
+        > So far: {{out}}
+        > {{x}} then: [y]
+    <out>
+        > {{y}}
+    </out>
+endfor
+> done
+return
+"""
+    lines = [line + "\n" for line in program.strip("\n").split("\n")]
+    interpreter = silas.Interpreter(lines, backend=silas.MockBackend(default="7"), concurrency=8)
+    out = interpreter.run()[0] # the out block
+    assert len(out) == 302
+    assert out.prompt() == "".join(str(line) for line in out.lines)
+    assert out.offsets == [0] + [6 + 2 * i for i in range(301)] + [6 + 2 * 300 + 5]
+
+# context policies ########################################
+
+class PromptsBackend(silas.Backend):
+    # records the prompts it is asked to complete
+    model = "prompts"
+
+    def __init__(self):
+        self.prompts = []
+
+    def complete(self, prompt, stop, max_tokens=None):
+        self.prompts.append(prompt)
+        return "ok"
+
+LINES = "".join(f"> w{i} x{i}\n" for i in range(1, 6)) # 2 tokens each
+
+
+def context_prompts(program):
+    backend = PromptsBackend()
+    run(program, backend=backend)
+    return backend.prompts
+
+
+def test_block_policies():
+    for policy, seen, seen_after_pop in [
+        ("last 2", "w4 x4\nw5 x5\n", "w3 x3\nw4 x4\n"),
+        ("tokens 4", "w4 x4\nw5 x5\n", "w3 x3\nw4 x4\n"),
+        ("head 1 tail 1", "w1 x1\nw5 x5\n", "w1 x1\nw4 x4\n"),
+    ]:
+        program = f"<b @{policy}>\n{LINES}> Q: [a]\npop 2\n> R: [c]\nreturn"
+        assert context_prompts(program) == [seen + "Q: ", seen_after_pop + "R: "], policy
+
+
+def test_hole_policies():
+    for policy, seen, seen_after_pop in [
+        ("last 1", "w5 x5\n", "w4 x4\n"),
+        ("tokens 2", "w5 x5\n", "w4 x4\n"),
+        ("head 2 tail 1", "w1 x1\nw2 x2\nw5 x5\n", "w1 x1\nw2 x2\nw4 x4\n"),
+    ]:
+        program = f"{LINES}> Q: [a|@{policy}]\npop 2\n> R: [c|@{policy}]\n> S: [d]\nreturn"
+        whole = "w1 x1\nw2 x2\nw3 x3\nw4 x4\nR: ok\nS: " # no policy on the last hole
+        assert context_prompts(program) == [seen + "Q: ", seen_after_pop + "R: ", whole], policy
+
+# primitives ########################################
+
+def test_primitives_named_like_keywords():
+    calls = []
+    def debug_dump(args):
+        calls.append(args)
+        return "dumped"
+    def pop_all(args):
+        return "popped"
+    program = """
+> a
+debug-dump 1
+pop-all 0
+return
+"""
+    assert run(program, primitives={"debug-dump": debug_dump, "pop-all": pop_all}) == "dumped\npopped\n"
+    assert len(calls) == 1
+
+RATINGS = """
+> 7/10
+> 9/10
+> 7/10
+> no rating
+"""
+
+
+def test_numeric_primitives():
+    assert run(RATINGS + "count *\nreturn") == "3\n" # the text line has no number
+    assert run(RATINGS + "sum *\nreturn") == "23\n"
+    assert run(RATINGS + "mean *\nreturn") == f"{23 / 3!r}\n"
+    assert run(RATINGS + "histogram *\nreturn") == "7: 2\n9: 1\n"
+
+
+def test_column():
+    program = RATINGS + """
+column *
+pop to col
+<out>
+for x in col
+    <out>
+        > {x}!
+    </out>
+endfor
+return
+"""
+    assert run(program) == "7!\n9!\n7!\n"
+    assert run(RATINGS + "column *\nmean 1\nreturn") == f"{23 / 3!r}\n"
+
+
+def test_batch_primitives_from_file(tmp_path):
+    path = tmp_path / "functions.py"
+    path.write_text("""
+import silas
+
+class Array:
+    # stands in for a numpy array
+    def __init__(self, values):
+        self.values = values
+
+    def tolist(self):
+        return self.values
+
+@silas.batch
+def sort_lines(lines):
+    return sorted(lines)
+
+@silas.batch
+def double(lines):
+    return Array([2 * x for x in lines])
+""")
+    primitives = silas.load_functions(str(path))
+    assert sorted(primitives) == ["double", "sort-lines"] # no classes or imported functions
+    assert run("> b\n> c\n> a\nsort-lines *\nreturn", primitives=primitives) == "a\nb\nc\n"
+    assert run("> 1\n> 2.5\ndouble *\nreturn", primitives=primitives) == "2\n5.0\n"
+
+# memo ########################################
+
+SHOUT = """
+# Shout (memo)
+> said: [y]
+pop 2
+> {y}
+return
+"""
+
+
+def test_memo_skips_repeated_calls():
+    calls = "".join(f"> {word}\ncall Shout 1\n" for word in "abab")
+    backend = EchoBackend()
+    assert run(calls + "return\n" + SHOUT, backend=backend) == "A\nB\nA\nB\n"
+    assert backend.n == 2 # once per distinct argument
+
+
+def test_memo_forgets_least_recently_used():
+    calls = "".join(f"> {word}\ncall Shout 1\n" for word in "abaca")
+    backend = EchoBackend()
+    assert run(calls + "return\n" + SHOUT, backend=backend, memo_size=2) == "A\nB\nA\nC\nA\n"
+    assert backend.n == 3 # c evicts b, which was used less recently than a
+
+    backend = EchoBackend()
+    run(calls + "return\n" + SHOUT, backend=backend, memo_size=1)
+    assert backend.n == 5
+
+# batch file backend ########################################
+
+def test_batch_pfor_writes_every_iteration(tmp_path):
+    import json
+    import pytest
+    requests_path = tmp_path / "requests.jsonl"
+    results_path = tmp_path / "results.jsonl"
+    items = "\n".join(f"> item {i}" for i in range(40))
+    program = f"""
+<items>
+{items}
+</items>
+<out>
+pfor x in items
+        > Rate {{x}}: [r|*\\n]
+    <out>
+        > {{r}}
+    </out>
+endfor
+return
+"""
+    with pytest.raises(silas.BatchPending) as pending:
+        run(program, backend=silas.BatchFileBackend(str(requests_path)), concurrency=4)
+    with open(requests_path) as f:
+        requests = [json.loads(line) for line in f]
+    assert len(requests) == 40
+    assert str(pending.value) == f"40 requests waiting in {requests_path}"
+
+    with open(results_path, "w") as f:
+        for request in requests:
+            body = {"choices": [{"message": {"content": "5"}}]}
+            f.write(json.dumps({"custom_id": request["custom_id"], "response": {"body": body}}) + "\n")
+    backend = silas.BatchFileBackend(str(requests_path), str(results_path))
+    assert run(program, backend=backend, concurrency=4) == "5\n" * 40
+
+# prefetch ########################################
+
+PREFETCH_PROGRAM = """
+<out>
+for review in reviews
+        > Review: "{review}"
+        > Rating: [rating|*\\n]
+    <out>
+        > {rating} {review}
+    </out>
+endfor
+return
+"""
+
+def test_prefetch_same_result(tmp_path):
+    path = tmp_path / "reviews.txt"
+    path.write_text("".join(f"review {i}\n" for i in range(50)))
+    backend = silas.MockBackend(default="7")
+    expected = run(PREFETCH_PROGRAM, backend=backend, inputs={"reviews": silas.StreamBlock(str(path))})
+    assert expected == "".join(f"7 review {i}\n" for i in range(50))
+    for prefetch in [1, 3]:
+        stream = silas.StreamBlock(str(path))
+        assert run(PREFETCH_PROGRAM, backend=backend, prefetch=prefetch, inputs={"reviews": stream}) == expected
+        block = silas.Block([silas.parse_arg(f"review {i}") for i in range(50)])
+        assert run(PREFETCH_PROGRAM, backend=backend, prefetch=prefetch, inputs={"reviews": block}) == expected
+
+
+def test_prefetch_reads_each_item_once(tmp_path):
+    # once by the loop and once by the prefetcher, plus the end of the file
+    # noticed by each
+    path = tmp_path / "reviews.txt"
+    path.write_text("".join(f"review {i}\n" for i in range(50)))
+    stream = silas.StreamBlock(str(path))
+    reads = []
+    read = stream.read
+    stream.read = lambda offset: reads.append(offset) or read(offset)
+    run(PREFETCH_PROGRAM, prefetch=4, inputs={"reviews": stream})
+    assert len(reads) <= 2 * 50 + 4 + 1
+
+# completion cache ########################################
+
+def test_cache_size_bound(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = silas.CompletionCache(path, max_entries=10, max_bytes=10_000)
+    for i in range(500):
+        cache.put(f"key {i}", "x" * 50, size=50)
+    cache.put("key 499", "y" * 10) # replaced, not added
+    assert cache.total == cache.stored_bytes() <= 10_000
+    assert cache.get("key 499") == "y" * 10
+    assert cache.get("key 0") is None # evicted
+
+    reopened = silas.CompletionCache(path, max_bytes=10_000)
+    assert reopened.total == cache.total
+    assert reopened.get("key 498") == "x" * 50
+
+# choice holes ########################################
+
+def test_choice_hole():
+    program = """
+> Sentiment: [label|=pos|=neg]
+return
+"""
+    assert run(program, default=" Neg.") == "Sentiment: neg\n"
+    assert run(program, default="positive") == "Sentiment: pos\n"
+
+
+def test_choice_hole_without_match():
+    import pytest
+    program = """
+> Sentiment: [label|=pos|=neg]
+return
+"""
+    with pytest.raises(Exception, match=r"\(line 1\) choice hole: completion 'garbage' matches none"):
+        run(program, default="garbage")
+
+# serve ########################################
+
+def serve(*requests, **options):
+    # -> {id: response} from a Server answering request lines
+    import json
+    backend = silas.MockBackend([
+        {"match": "Sturdy", "completion": "8"},
+        {"match": "Horrible", "completion": "1"},
+    ], default="5")
+    server = silas.Server({"backend": backend, "concurrency": 4, "cache": None, **options})
+    out = []
+    server.serve([json.dumps(request) if isinstance(request, dict) else request for request in requests], out.append)
+    server.close()
+    return {response["id"]: response for response in map(json.loads, "".join(out).splitlines())}
+
+
+def test_serve_example():
+    # the example in the README
+    reviews = ["Sturdy and well made", "Horrible. Just horrible."]
+    params = {"program": os.path.join(ROOT, "examples", "rate_input_reviews.md"), "inputs": {"reviews": reviews}}
+    responses = serve({"jsonrpc": "2.0", "id": 1, "method": "run", "params": params})
+    assert responses[1]["result"] == {"result": [["8/10", "1/10"]], "completions": 2}
+
+
+def test_serve_errors():
+    source = "> Hi [x]\nreturn\n"
+    responses = serve(
+        {"jsonrpc": "2.0", "id": 1, "method": "run", "params": {"source": source}},
+        "not json",
+        {"jsonrpc": "2.0", "id": 2, "method": "nope"},
+        {"jsonrpc": "2.0", "id": 3, "method": "run", "params": {"program": "missing.md"}},
+        {"jsonrpc": "2.0", "method": "run", "params": {"source": source}}, # notification
+    )
+    assert responses[1]["result"] == {"result": ["Hi 5"], "completions": 1}
+    assert responses[None]["error"]["code"] == -32700
+    assert responses[2]["error"]["code"] == -32601
+    assert responses[3]["error"]["code"] == -32000
+    assert len(responses) == 4
+
+
+def test_serve_counts_pfor_completions():
+    source = "<out>\npfor x in reviews\n        > {x}: [r]/10\n    <out>\n        > {r}\n    </out>\nendfor\nreturn\n"
+    reviews = ["Sturdy", "Horrible", "Fine", "Okay"]
+    responses = serve({"jsonrpc": "2.0", "id": 1, "method": "run", "params": {"source": source, "inputs": {"reviews": reviews}}})
+    assert responses[1]["result"] == {"result": [[8, 1, 5, 5]], "completions": 4}
+
+# inputs ########################################
+
+def test_stream_input_in_prompt(tmp_path):
+    import pytest
+    path = tmp_path / "items.txt"
+    path.write_text("a\nb\n")
+    for prefetch in [0, 2]:
+        with pytest.raises(AssertionError, match=r"\(line 3\) \{items\}: input block 'items' is read lazily"):
+            run("for x in items\n        > {x}\n        > all: {items} [y]\nendfor\nreturn", prefetch=prefetch, inputs={"items": silas.StreamBlock(str(path))})
+
+
+# checkpoints ########################################
+
+def test_resume_after_interrupt(tmp_path):
+    import pytest
+    items = "\n".join(f"> item{i}" for i in range(10))
+    program = f"""
+<items>
+{items}
+</items>
+<out>
+for x in items
+        > Say {{x}}
+        > Then: [y]
+    <out>
+        > {{y}}
+    </out>
+endfor
+return
+"""
+    expected = run(program, backend=EchoBackend())
+    checkpoint = str(tmp_path / "run.ckpt")
+    output = tmp_path / "out.jsonl"
+
+    with pytest.raises(KeyboardInterrupt):
+        run(program, backend=EchoBackend(interrupt_after=5), checkpoint=checkpoint, checkpoint_every=2,
+            sinks={"out": silas.Sink(str(output))})
+    assert os.path.exists(checkpoint)
+
+    resumed = EchoBackend()
+    result = run(program, backend=resumed, checkpoint=checkpoint, resume=checkpoint, sinks={"out": silas.Sink(str(output))})
+    assert result == expected
+    assert resumed.n == 6 # the completions after the last checkpoint, and the rest
+    assert output.read_text() == "".join(f'"ITEM{i}"\n' for i in range(10))
+    assert not os.path.exists(checkpoint)
+
+def test_checkpoint_after_pfor(tmp_path):
+    items = "\n".join(f"> item{i}" for i in range(16))
+    program = f"""
+<items>
+{items}
+</items>
+<out>
+pfor x in items
+        > Say {{x}}
+        > Then: [y]
+    <out>
+        > {{y}}
+    </out>
+endfor
+return
+"""
+    saved = []
+    class Recorded(silas.Interpreter):
+        def save(self, path):
+            saved.append(self.n_completions)
+
+    lines = [line + "\n" for line in program.strip("\n").split("\n")]
+    interpreter = Recorded(lines, backend=EchoBackend(), concurrency=4, checkpoint=str(tmp_path / "run.ckpt"), checkpoint_every=3)
+    interpreter.run()
+    assert saved == [16] # the iterations' completions count towards the next checkpoint
+
+# sharding ########################################
+
+def test_shard_input(tmp_path):
+    import subprocess
+    (tmp_path / "items.txt").write_text("".join(f"item{i}\n" for i in range(10)))
+    (tmp_path / "prog.md").write_text("""<out>
+for x in items
+        > Rate {x}: [r]
+    <out>
+        > {x} {r}
+    </out>
+endfor
+return
+""")
+    command = [sys.executable, os.path.join(ROOT, "silas.py"), "prog.md", "--backend", "mock", "--mock-default", "ok",
+               "--shard-input", "items=items.txt", "--shard-size", "3", "--workers", "2", "-o", "out=out.jsonl"]
+    done = subprocess.run(command, cwd=tmp_path, capture_output=True, text=True, timeout=60)
+    assert done.returncode == 0, done.stderr
+    assert done.stdout == "".join(f"item{i} ok\n" for i in range(10)) # 4 shards, in input order
+    assert (tmp_path / "out.jsonl").read_bytes() == "".join(f'"item{i} ok"\n' for i in range(10)).encode()
+
+# profiler ########################################
+
+def test_profiler_charges_lines_to_their_function():
+    program = """
+many 0
+call Noop *
+return
+
+# Noop
+return
+"""
+    lines = [line + "\n" for line in program.strip("\n").split("\n")]
+    profiler = silas.Profiler()
+    primitives = {"many": lambda args: list(range(200_000))}
+    silas.Interpreter(lines, primitives=primitives, backend=silas.MockBackend(), profiler=profiler).run()
+    report = profiler.report(silas.Program.parse(lines))
+
+    call = next(line for line in report["lines"] if line["source"] == "call Noop *")
+    functions = {fct["function"]: fct for fct in report["functions"]}
+    assert functions["Noop"]["calls"] == 1
+    # copying 200k arguments happens on the call line, in Main
+    assert functions["Noop"]["seconds"] < call["seconds"] / 2
+    assert functions["Main"]["seconds"] >= call["seconds"]